@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Benchmarks of log_analyzer stages on synthetic ui_short logs.
+
+$ python3 benchmark.py --lines 1000000 --output bench.json
+$ python3 benchmark.py --lines 1000000 --baseline bench.json
+"""
+import argparse
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+if __package__:
+    from . import log_analyzer
+else:
+    import log_analyzer
+
+USER_AGENTS = (
+    'Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like '
+    'Gecko) Chrome/59.0.3071.115 Safari/537.36',
+    'python-requests/2.13.0',
+    '-',
+)
+
+URL_TEMPLATES = (
+    '/api/v2/banner/{id}',
+    '/api/v2/group/{id}/statistic/sites/?date_type=day&date_from=2017-06-28',
+    '/api/1/photogenic_banners/list/?server_name=WIN7RB{id}',
+    '/export/appinstall_raw/2017-06-{day:02d}/',
+    '/api/v2/slot/{id}/groups',
+)
+
+# Ways to break a line: each one makes parse_line raise ValueError.
+MALFORMED = (
+    lambda line: line[:len(line) // 2],
+    lambda line: line.rsplit(' ', 1)[0] + ' -',
+    lambda line: line.replace('"GET ', '"', 1).replace(' HTTP/1.1"', '"', 1),
+    lambda line: '',
+)
+
+STAGES = (
+    'read_lines',
+    'parse_line',
+    'collect_time_data',
+    'calculate_statistics',
+    'scan_log',
+    'build_time_data',
+    'report',
+)
+
+
+def make_urls(count, rnd):
+    """ Returns count different URLs. """
+    urls = []
+    for index in range(count):
+        template = URL_TEMPLATES[index % len(URL_TEMPLATES)]
+        urls.append(template.format(id=index, day=index % 28 + 1))
+    rnd.shuffle(urls)
+    return urls
+
+
+def make_line(rnd, url, request_time, moment):
+    return (
+        '%d.%d.%d.%d %s  - [%s] "GET %s HTTP/1.1" %d %d "-" "%s" "-" '
+        '"%d-%d-4708-%d" "%s" %.3f' % (
+            rnd.randint(1, 223), rnd.randint(0, 255), rnd.randint(0, 255),
+            rnd.randint(1, 254), '%08x' % rnd.getrandbits(32),
+            moment.strftime('%d/%b/%Y:%H:%M:%S +0300'), url,
+            rnd.choice((200, 200, 200, 404, 500)), rnd.randint(0, 100000),
+            rnd.choice(USER_AGENTS), int(moment.timestamp()),
+            rnd.getrandbits(31), rnd.getrandbits(23),
+            '%09x' % rnd.getrandbits(36), request_time)
+    )
+
+
+def generate_lines(lines, urls=1000, latency_mu=-1.2, latency_sigma=1.0,
+                   error_rate=0.0, seed=0):
+    """ Yields lines of ui_short log. The same arguments always give the
+    same lines. URLs are chosen by a Zipf-like law, request times are
+    lognormal with latency_mu and latency_sigma (of the natural log of
+    seconds). error_rate of lines are malformed.
+    """
+    rnd = random.Random(seed)
+    url_list = make_urls(urls, rnd)
+    # Weights 1/rank, so a few URLs take most requests as in real logs.
+    cum_weights = []
+    total = 0
+    for rank in range(1, urls + 1):
+        total += 1 / rank
+        cum_weights.append(total)
+    moment = datetime(2017, 6, 29, 3, 50, 22)
+    step = timedelta(seconds=86400 / max(lines, 1))
+    for _ in range(lines):
+        url = rnd.choices(url_list, cum_weights=cum_weights)[0]
+        request_time = min(rnd.lognormvariate(latency_mu, latency_sigma),
+                           600)
+        line = make_line(rnd, url, request_time, moment)
+        if error_rate and rnd.random() < error_rate:
+            line = rnd.choice(MALFORMED)(line)
+        moment += step
+        yield line
+
+
+def generate_log(path, lines, urls=1000, latency_mu=-1.2, latency_sigma=1.0,
+                 error_rate=0.0, seed=0):
+    """ Writes generated log to path, gzip compressed if path ends with .gz.
+    Returns size of the file.
+    """
+    open_func = gzip.open if path.endswith('.gz') else open
+    with open_func(path, 'wt') as log:
+        for line in generate_lines(lines, urls, latency_mu, latency_sigma,
+                                   error_rate, seed):
+            log.write(line)
+            log.write('\n')
+    return os.path.getsize(path)
+
+
+def run_stage(stage, log_path, backend='python'):
+    """ Runs one stage over the log with the statistics backend. Returns
+    number of processed lines.
+    """
+    if stage == 'read_lines':
+        return sum(1 for _ in log_analyzer.read_lines(log_path))
+    if stage == 'parse_line':
+        lines = 0
+        for line in log_analyzer.read_lines(log_path):
+            lines += 1
+            try:
+                log_analyzer.parse_line(line)
+            except ValueError:
+                pass
+        return lines
+    if stage == 'collect_time_data':
+        log = log_analyzer.parse_log(log_path, 100)
+        return log_analyzer.collect_time_data(log)['requests_count']
+    if stage == 'calculate_statistics':
+        log = log_analyzer.parse_log(log_path, 100)
+        stats = log_analyzer.calculate_statistics(log, backend=backend)
+        return sum(row['count'] for row in stats)
+    if stage == 'scan_log':
+        return sum(1 for _ in log_analyzer.scan_log(log_path, 100))
+    config = dict(log_analyzer.config, MAX_PARS_ERRORS_PERC=100,
+                  STATS_BACKEND=backend)
+    if stage == 'build_time_data':
+        return log_analyzer.build_time_data(log_path, config)[
+            'requests_count']
+    if stage == 'report':
+        time_data = log_analyzer.build_time_data(log_path, config)
+        with tempfile.TemporaryDirectory() as report_dir:
+            log_analyzer.write_report(
+                time_data, config, os.path.join(report_dir, 'report.html'))
+        return time_data['requests_count']
+    raise ValueError('Unknown stage %s' % stage)
+
+
+def measure_stage(stage, log_path, allocations=False, backend='python'):
+    """ Runs the stage and returns its measurements. Runs in a fresh
+    process, so peak RSS belongs to this stage only.
+    """
+    logging.disable(logging.CRITICAL)
+    result = {}
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    lines = run_stage(stage, log_path, backend)
+    result['seconds'] = time.perf_counter() - start
+    result['cpu_seconds'] = time.process_time() - cpu_start
+    result['lines'] = lines
+    result['lines_per_sec'] = lines / result['seconds']
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['peak_rss'] = maxrss if sys.platform == 'darwin' else maxrss * 1024
+    if allocations:
+        # tracemalloc slows the stage down, so it is run once more.
+        tracemalloc.start()
+        run_stage(stage, log_path, backend)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result['alloc_peak'] = peak
+        result['alloc_current'] = current
+    return result
+
+
+def measure_store(log_path):
+    """ Returns memory taken by time_data of the log for every kind of
+    aggregate store: in total, per URL and per line. Runs in a fresh
+    process.
+    """
+    logging.disable(logging.CRITICAL)
+    kinds = [('sketch', 0.01, 'python'), ('lists', None, 'python')]
+    if log_analyzer.get_numpy() is not None:
+        kinds.append(('columnar', None, 'numpy'))
+    result = {}
+    for kind, median_error, backend in kinds:
+        tracemalloc.start()
+        time_data = log_analyzer.collect_url_times(
+            log_analyzer.scan_log(log_path, 100), median_error, backend)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        urls = len(time_data.get('urls') or time_data['items'])
+        result[kind] = {
+            'bytes': size,
+            'urls': urls,
+            'bytes_per_url': size / urls,
+            'bytes_per_line': size / time_data['requests_count'],
+        }
+        del time_data
+    return result
+
+
+def run_benchmarks(log_paths, stages=STAGES, repeat=3, allocations=False,
+                   backend='python'):
+    """ Returns results of every stage for every log. Best time of repeat
+    runs is kept. Results of numpy backend are named with :numpy suffix.
+    """
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for name, log_path in log_paths.items():
+        for stage in stages:
+            runs = []
+            for index in range(repeat):
+                with context.Pool(1) as pool:
+                    runs.append(pool.apply(
+                        measure_stage,
+                        (stage, log_path, allocations and index == 0,
+                         backend)))
+            best = min(runs, key=lambda run: run['seconds'])
+            best['peak_rss'] = max(run['peak_rss'] for run in runs)
+            for key in ('alloc_peak', 'alloc_current'):
+                if key in runs[0]:
+                    best[key] = runs[0][key]
+            key = '%s:%s' % (stage, name)
+            if backend != 'python':
+                key += ':' + backend
+            results[key] = best
+            print('%-28s %8.3f s %12.0f lines/s %8.1f MiB' % (
+                key, best['seconds'],
+                best['lines_per_sec'], best['peak_rss'] / 2 ** 20))
+    return results
+
+
+def run_store_benchmark(log_path):
+    """ Prints and returns results of measure_store. """
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        results = pool.apply(measure_store, (log_path,))
+    for kind, result in results.items():
+        print('store:%-22s %8.1f MiB %8.0f B/url %8.1f B/line' % (
+            kind, result['bytes'] / 2 ** 20, result['bytes_per_url'],
+            result['bytes_per_line']))
+    return results
+
+
+def compare(results, baseline):
+    """ Prints speed of results relative to baseline results. """
+    print('\nCompared with baseline (>1 is faster):')
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        speedup = base['seconds'] / result['seconds']
+        memory = result['peak_rss'] / base['peak_rss']
+        print('%-28s x%.2f speed, x%.2f peak RSS' % (key, speedup, memory))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark log_analyzer stages on a generated log')
+    parser.add_argument('--lines', type=int, default=200000,
+                        help='Number of lines of the log')
+    parser.add_argument('--urls', type=int, default=1000,
+                        help='Number of different URLs')
+    parser.add_argument('--latency-mu', type=float, default=-1.2,
+                        help='Mean of the natural log of request time')
+    parser.add_argument('--latency-sigma', type=float, default=1.0,
+                        help='Deviation of the natural log of request time')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Part of malformed lines')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-gz', dest='gz', action='store_false',
+                        help='Do not benchmark gzip log')
+    parser.add_argument('--stages', nargs='+', choices=STAGES,
+                        default=list(STAGES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--backend', choices=('python', 'numpy'),
+                        default='python',
+                        help='Statistics backend of calculate_statistics, '
+                             'build_time_data and report stages')
+    parser.add_argument('--allocations', action='store_true',
+                        help='Measure peak of allocations with tracemalloc')
+    parser.add_argument('--store', action='store_true',
+                        help='Measure memory of aggregates per URL and '
+                             'per line')
+    parser.add_argument('--log-dir',
+                        help='Where to keep generated logs (temporary '
+                             'directory by default)')
+    parser.add_argument('--output', help='Save results to JSON file')
+    parser.add_argument('--baseline', help='JSON file of a previous run')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    log_dir = args.log_dir or tempfile.mkdtemp(prefix='log_analyzer_bench')
+    os.makedirs(log_dir, exist_ok=True)
+    generator_args = {
+        'lines': args.lines,
+        'urls': args.urls,
+        'latency_mu': args.latency_mu,
+        'latency_sigma': args.latency_sigma,
+        'error_rate': args.error_rate,
+        'seed': args.seed,
+    }
+    name = 'bench-{lines}-{urls}-{error_rate}-{seed}.log'.format(
+        **generator_args)
+    log_paths = {'plain': os.path.join(log_dir, name)}
+    if args.gz:
+        log_paths['gz'] = log_paths['plain'] + '.gz'
+    sizes = {}
+    for kind, log_path in log_paths.items():
+        if not os.path.exists(log_path):
+            generate_log(log_path, **generator_args)
+        sizes[kind] = os.path.getsize(log_path)
+        print('%s log: %s (%.1f MiB)' % (kind, log_path,
+                                          sizes[kind] / 2 ** 20))
+
+    results = run_benchmarks(log_paths, args.stages, args.repeat,
+                             args.allocations, args.backend)
+    run = {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'numpy': log_analyzer.get_numpy() is not None,
+            'backend': args.backend,
+            'generator': generator_args,
+            'log_sizes': sizes,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    if args.store:
+        run['store'] = run_store_benchmark(log_paths['plain'])
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(run, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            compare(results, json.load(baseline)['results'])
+
+
+if __name__ == '__main__':
+    main()
@@ -5,28 +5,83 @@
 #                     '$status $body_bytes_sent '$http_referer' '
 #                     ''$http_user_agent' '$http_x_forwarded_for' '$http_X_REQUEST_ID' '$http_X_RB_USER' '
 #                     '$request_time';
+import abc
 import argparse
+import array
+import asyncio
 import collections
+import contextlib
+import cProfile
+import csv
 import functools
 import gzip
+import heapq
+import io
+import itertools
 import json
 import logging
+import math
+import mmap
 import os
+import pstats
 import re
+import resource
+import shlex
+import shutil
+import struct
+import subprocess
+import sys
+import time
+import tracemalloc
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from statistics import median
-from string import Template
 
 config = {
     'REPORT_SIZE': 1000,
+    'REPORT_FORMATS': ['html'],
     'REPORT_DIR': './reports',
     'LOG_DIR': './log',
     'LOG_PREFIX': 'nginx-access-ui',
     'MAX_PARS_ERRORS_PERC': 10,
+    'WORKERS': 1,
+    'MEDIAN_ERROR': 0.01,
+    'EXACT_MEDIAN': False,
+    'PERCENTILES': [75, 95, 99],
+    'STATS_BACKEND': 'python',
+    'DECOMPRESSOR': 'auto',
+    'AGGREGATE_DIR': './aggregates',
+    'CHECKPOINT_BYTES': 1024 ** 3,
+    'FOLLOW_INTERVAL': 10,
+    'FOLLOW_LINES': 100000,
+    'URL_RULES': [],
+    'QUERY_PARAMS': None,
+    'MAX_URLS': None,
+    'SUMMARY_FILE': None,
+    'ERRORS_WARMUP_LINES': 10000,
+    'LOG_INDEX': True,
+    'BREAKDOWNS': [],
+    'SOURCES': [],
+    'SOURCE_WORKERS': None,
 }
 
 LogMeta = collections.namedtuple('LogMeta', ['path', 'date'])
 
+BLOCK_SIZE = 1024 * 1024
+
+# Compressed bytes which may be read ahead of the parsed lines: the block
+# being split into lines and buffers of the decompressor.
+READ_AHEAD = 2 * BLOCK_SIZE
+
+# Commands which read gzip file from stdin and write it decompressed to
+# stdout.
+DECOMPRESSORS = {
+    'pigz': ['pigz', '-dc'],
+    'zcat': ['zcat'],
+    'gzip': ['gzip', '-dc'],
+}
+
 
 def log_time_execution(func):
     @functools.wraps(func)
@@ -39,6 +94,121 @@ def log_time_execution(func):
     return wrapped
 
 
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+class RunMetrics:
+    """ Counters and stage timings of one run of the script.
+
+    Stage times of worker processes are added up, so with --workers they
+    are CPU seconds rather than wall time. The 'build' stage is the wall
+    time of parsing logs.
+    """
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.timings = collections.Counter()
+        self.error_examples = {}
+        self.logs = []
+        self.sources = {}
+        self.started = time.perf_counter()
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] += time.perf_counter() - start
+
+    def timed(self, blocks, stage, counter):
+        """ Yields blocks. Time spent to produce them is added to stage and
+        their size to counter.
+        """
+        blocks = iter(blocks)
+        while True:
+            start = time.perf_counter()
+            block = next(blocks, None)
+            self.timings[stage] += time.perf_counter() - start
+            if block is None:
+                return
+            self.counters[counter] += len(block)
+            yield block
+
+    def batches(self, items, stage, batch_size=65536):
+        """ Yields lists of items. Time spent to produce them is added to
+        stage, time spent by the consumer is not.
+        """
+        items = iter(items)
+        while True:
+            start = time.perf_counter()
+            batch = list(itertools.islice(items, batch_size))
+            self.timings[stage] += time.perf_counter() - start
+            if not batch:
+                return
+            yield batch
+
+    def merge(self, other):
+        self.counters.update(other.counters)
+        self.timings.update(other.timings)
+        self.logs.extend(other.logs)
+        for column, examples in other.error_examples.items():
+            self.error_examples.setdefault(column, []).extend(examples)
+
+    def add_parse_counters(self, counters):
+        """ Adds lines and errors of ParseCounters. """
+        self.counters['total'] += counters.total
+        self.counters['errors'] += counters.errors
+        for column, count in counters.columns.items():
+            self.counters['errors:%s' % column] += count
+        for column, examples in counters.examples.items():
+            self.error_examples.setdefault(column, []).extend(examples)
+
+    def summary(self):
+        """ Returns dict with counters, timings, throughput and peak memory
+        which can be dumped to JSON.
+        """
+        counters = self.counters
+        timings = dict(self.timings)
+        # Time of decompression is a part of time of parsing.
+        if 'parse' in timings:
+            timings['parse'] = max(
+                timings['parse'] - timings.get('decompress', 0), 0)
+        build = self.timings.get('build')
+        errors_by_column = {
+            key.split(':', 1)[1]: value
+            for key, value in sorted(counters.items())
+            if key.startswith('errors:')
+        }
+        return {
+            'seconds': round(time.perf_counter() - self.started, 3),
+            'bytes_read': counters['bytes_read'],
+            'bytes_decompressed': counters['bytes_decompressed'],
+            'lines_read': counters['total'],
+            'lines_parsed': counters['total'] - counters['errors'],
+            'parse_errors': counters['errors'],
+            'parse_errors_by_column': errors_by_column,
+            'parse_error_examples': self.error_examples,
+            'max_urls_per_log': max(
+                (log['urls'] for log in self.logs), default=0),
+            'timings': {
+                stage: round(seconds, 3)
+                for stage, seconds in sorted(timings.items())
+            },
+            'lines_per_sec': (
+                round(counters['total'] / build) if build else None),
+            'bytes_per_sec': (
+                round(counters['bytes_read'] / build) if build else None),
+            'peak_rss': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT,
+            'peak_rss_workers': resource.getrusage(
+                resource.RUSAGE_CHILDREN).ru_maxrss * RSS_UNIT,
+            'logs': self.logs,
+            'sources': self.sources,
+        }
+
+
 def date_from_name(name):
     """ Returns datetime object with date from name. """
     if name:
@@ -47,27 +217,222 @@ def date_from_name(name):
             return datetime.strptime(date_match.group(), '%Y%m%d')
 
 
+@functools.lru_cache(maxsize=None)
+def log_name_pattern(log_prefix):
+    return re.compile(r'%s.log-(\d{8})(\.gz)?$' % log_prefix)
+
+
+def log_name_date(date):
+    """ Returns datetime from YYYYMMDD string, faster than strptime. """
+    return datetime(int(date[:4]), int(date[4:6]), int(date[6:]))
+
+
+def get_logs(log_prefix, log_dir):
+    """ Returns LogMeta of all logs with log_prefix sorted by date. """
+    pattern = log_name_pattern(log_prefix)
+    logs = []
+    for file in os.listdir(log_dir):
+        match = pattern.match(file)
+        if match:
+            logs.append(LogMeta(os.path.join(log_dir, file),
+                                log_name_date(match.group(1))))
+    return sorted(logs, key=lambda log: log.date)
+
+
 def get_last_log(log_prefix, log_dir):
-    last_log = ''
-    last_date = datetime(1, 1, 1)
-    pattern = r'%s.log-\d{8}(\.gz)?$' % log_prefix
-
-    files = os.listdir(log_dir)
-    for file in files:
-        if re.match(pattern, file):
-            date = date_from_name(file)
-            if date > last_date:
-                last_date = date
-                last_log = file
-    if last_log:
-        path = os.path.join(log_dir, last_log)
-        return LogMeta(path, last_date)
-
-
-def construct_report_name(logmeta, report_dir, report_prefix='report'):
+    logs = get_logs(log_prefix, log_dir)
+    if logs:
+        return logs[-1]
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w', **kwargs):
+    """ Opens a temporary file next to path, which replaces path when the
+    block ends and is removed if it fails, so readers never see a partial
+    file.
+    """
+    tmp_path = '%s.tmp%s' % (path, os.getpid())
+    try:
+        with open(tmp_path, mode, **kwargs) as tmp_file:
+            yield tmp_file
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+
+class LogIndex:
+    """ Persisted index of logs in log_dir: name -> [date, size, mtime].
+    Only new logs of the directory are parsed and stated, and the
+    directory is not scanned at all while its mtime is unchanged.
+
+    Reports found for logs are recorded with mtime of their directory,
+    so while it is unchanged only logs without recorded reports are
+    checked on disk.
+    """
+    VERSION = 3
+    # Directory changes within this many seconds of its mtime may be not
+    # visible in the mtime yet, so such mtime is not trusted.
+    RACY_SECONDS = 2
+
+    def __init__(self, path, log_prefix, log_dir):
+        self.path = path
+        self.log_prefix = log_prefix
+        self.log_dir = log_dir
+        self.dir_mtime = None
+        self.files = {}
+        # report dir -> [its mtime, {log name: paths of its reports}]
+        self.reports = {}
+        self.checked_report_dir = None
+        self.changed = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as index_file:
+                index = json.load(index_file)
+        except FileNotFoundError:
+            return
+        except ValueError as err:
+            logging.warning('Log index %s is broken: %s', self.path, err)
+            return
+        if (index.get('version') != self.VERSION
+                or index.get('log_prefix') != self.log_prefix
+                or index.get('log_dir') != self.log_dir):
+            return
+        self.dir_mtime = index['dir_mtime']
+        self.files = index['files']
+        self.reports = index['reports']
+
+    def save(self):
+        if self.checked_report_dir is not None:
+            # Taken after reports of this run are written: only later
+            # changes make the recorded reports checked again.
+            recorded = self.reports[self.checked_report_dir]
+            dir_mtime = _dir_mtime(self.checked_report_dir)
+            if recorded[0] != dir_mtime:
+                recorded[0] = dir_mtime
+                self.changed = True
+            self.checked_report_dir = None
+        if not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        index = {
+            'version': self.VERSION,
+            'log_prefix': self.log_prefix,
+            'log_dir': self.log_dir,
+            'dir_mtime': self.dir_mtime,
+            'files': self.files,
+            'reports': self.reports,
+        }
+        with atomic_write(self.path) as index_file:
+            json.dump(index, index_file)
+        self.changed = False
+
+    def update(self):
+        """ Adds new logs of log_dir and forgets removed ones. """
+        dir_mtime = os.stat(self.log_dir).st_mtime_ns
+        if dir_mtime == self.dir_mtime:
+            return
+        pattern = log_name_pattern(self.log_prefix)
+        names = set()
+        added = 0
+        with os.scandir(self.log_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                names.add(name)
+                if name in self.files:
+                    continue
+                match = pattern.match(name)
+                if not match:
+                    continue
+                stat = entry.stat()
+                # Fails on impossible dates as get_logs does.
+                log_name_date(match.group(1))
+                self.files[name] = [match.group(1), stat.st_size,
+                                    stat.st_mtime_ns]
+                added += 1
+        removed = [name for name in self.files if name not in names]
+        for name in removed:
+            del self.files[name]
+            for _, logs in self.reports.values():
+                logs.pop(name, None)
+        if time.time() - dir_mtime / 1e9 < self.RACY_SECONDS:
+            dir_mtime = None
+        self.dir_mtime = dir_mtime
+        self.changed = True
+        logging.info('Log index of %s: %s new, %s removed, %s logs',
+                     self.log_dir, added, len(removed), len(self.files))
+
+    def _logmeta(self, name):
+        return LogMeta(os.path.join(self.log_dir, name),
+                       log_name_date(self.files[name][0]))
+
+    def logs(self):
+        """ Returns LogMeta of all logs sorted by date. """
+        return [
+            self._logmeta(name) for name in
+            sorted(self.files, key=lambda name: self.files[name][0])
+        ]
+
+    def pending(self, report_dir, report_paths):
+        """ Returns LogMeta of logs, sorted by date, which miss some of
+        report_paths(logmeta) in report_dir. Reports recorded before are
+        trusted while report_dir is unchanged, others are checked and
+        recorded.
+        """
+        recorded = self.reports.get(report_dir)
+        if recorded is None or recorded[0] != _dir_mtime(report_dir):
+            # Reports may be removed: check all of them again.
+            recorded = self.reports[report_dir] = [None, {}]
+            self.changed = True
+        self.checked_report_dir = report_dir
+        reports = recorded[1]
+        pending = []
+        for log in self.logs():
+            name = os.path.basename(log.path)
+            known = reports.get(name, [])
+            missing = [path for path in report_paths(log)
+                       if path not in known]
+            if not all(os.path.isfile(path) for path in missing):
+                pending.append(log)
+            elif missing:
+                reports[name] = known + missing
+                self.changed = True
+        return pending
+
+    def last(self):
+        if self.files:
+            return self._logmeta(max(self.files,
+                                     key=lambda name: self.files[name][0]))
+
+
+def _dir_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def open_log_index(config):
+    """ Returns LogIndex of LOG_DIR kept in AGGREGATE_DIR or None if
+    LOG_INDEX is off.
+    """
+    aggregate_dir = config.get('AGGREGATE_DIR')
+    if not config.get('LOG_INDEX') or not aggregate_dir:
+        return None
+    log_prefix = config.get('LOG_PREFIX')
+    return LogIndex(os.path.join(aggregate_dir, 'logs-%s.json' % log_prefix),
+                    log_prefix, config.get('LOG_DIR'))
+
+
+def construct_report_name(logmeta, report_dir, report_prefix='report',
+                          extension='html'):
     # sample.log-20170630 -> report-2017.06.30.html
     date = logmeta.date
-    report_name = '%s-%s.html' % (report_prefix, date.strftime('%Y.%m.%d'))
+    report_name = '%s-%s.%s' % (
+        report_prefix, date.strftime('%Y.%m.%d'), extension)
     return os.path.join(report_dir, report_name)
 
 
@@ -81,39 +446,349 @@ def read_lines(log_path: str):
     with open_func(log_path, mode=mode) as log:
         logging.info('File "%s" is opened for analysis.', log_path)
         for line in log:
-            yield line
+            yield line.rstrip('\n')
+    logging.info('File "%s" is closed.', log_path)
+
+
+def get_decompressor(name='auto'):
+    """ Returns command for decompression of gzip logs or None if they
+    should be decompressed with zlib. 'auto' means pigz or zcat if one of
+    them is found in PATH.
+    """
+    if not name or name == 'python':
+        return None
+    auto = name == 'auto'
+    for candidate in ('pigz', 'zcat') if auto else (name,):
+        command = DECOMPRESSORS.get(candidate) or shlex.split(candidate)
+        if shutil.which(command[0]):
+            return command
+    if not auto:
+        raise RuntimeError('Decompressor "%s" is not found' % name)
+    return None
+
+
+def read_gzip_blocks(log_path, block_size=BLOCK_SIZE, progress=None):
+    """ Yields decompressed blocks of gzip file. Files of several gzip
+    members (e.g. made by `cat a.gz b.gz`) are read to the end. If
+    progress dict is given, its 'position' is compressed bytes read.
+    """
+    member = None
+    with open(log_path, 'rb') as log:
+        for data in iter(functools.partial(log.read, block_size), b''):
+            if progress is not None:
+                progress['position'] = log.tell()
+            while data:
+                if member is None:
+                    # Zero padding may follow the last member.
+                    data = data.lstrip(b'\x00')
+                    if not data:
+                        break
+                    member = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                block = member.decompress(data, block_size)
+                if block:
+                    yield block
+                if member.eof:
+                    data = member.unused_data
+                    member = None
+                else:
+                    data = member.unconsumed_tail
+    if member is not None:
+        raise EOFError('Compressed file "%s" ended before the end-of-stream '
+                       'marker was reached' % log_path)
+
+
+def read_command_blocks(command, block_size=BLOCK_SIZE, stdin=None,
+                        progress=None):
+    """ Yields blocks of stdout of the command. If progress dict is given,
+    its 'position' is bytes of stdin file read by the command: they share
+    the file offset.
+    """
+    process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE)
+    finished = False
+    try:
+        for block in iter(
+                functools.partial(process.stdout.read, block_size), b''):
+            if progress is not None:
+                progress['position'] = os.lseek(stdin.fileno(), 0,
+                                                os.SEEK_CUR)
+            yield block
+        finished = True
+    finally:
+        process.stdout.close()
+        if not finished:
+            process.kill()
+        returncode = process.wait()
+    if returncode:
+        raise RuntimeError('Command "%s" failed with code %s' % (
+            ' '.join(command), returncode))
+
+
+def read_blocks(log_path, block_size=BLOCK_SIZE, decompressor=None,
+                progress=None):
+    """ Yields blocks of decompressed bytes of the log. decompressor is a
+    command from get_decompressor; gzip logs are read with zlib if it is
+    None. progress of gzip logs is updated as read_gzip_blocks does.
+    """
+    if not log_path.endswith('.gz'):
+        with open(log_path, 'rb') as log:
+            yield from iter(functools.partial(log.read, block_size), b'')
+    elif decompressor:
+        with open(log_path, 'rb') as log:
+            yield from read_command_blocks(decompressor, block_size, log,
+                                           progress)
+    else:
+        yield from read_gzip_blocks(log_path, block_size, progress)
+
+
+def split_lines(blocks):
+    """ Splits blocks of bytes into lines without line breaks. """
+    tail = b''
+    for block in blocks:
+        lines = (tail + block).split(b'\n')
+        tail = lines.pop()
+        yield from lines
+    if tail:
+        yield tail
+
+
+def find_chunks(log_path, chunks_count):
+    """ Splits file into chunks_count byte ranges [start, end) which
+    begin and end on line boundaries. Empty ranges are dropped.
+    """
+    size = os.path.getsize(log_path)
+    if not size:
+        return []
+    bounds = [0]
+    with open(log_path, 'rb') as log, \
+            mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        for i in range(1, chunks_count):
+            pos = max(size * i // chunks_count, bounds[-1])
+            if pos:
+                pos = buf.find(b'\n', pos - 1) + 1 or size
+            bounds.append(pos)
+    bounds.append(size)
+    return [
+        (start, end) for start, end in zip(bounds, bounds[1:]) if start < end
+    ]
+
+
+def read_byte_lines(log_path, decompressor=None, metrics=None,
+                    progress=None):
+    logging.info('File "%s" is opened for analysis.', log_path)
+    blocks = read_blocks(log_path, decompressor=decompressor,
+                         progress=progress)
+    if metrics is not None:
+        blocks = metrics.timed(blocks, 'decompress', 'bytes_decompressed')
+    yield from split_lines(blocks)
     logging.info('File "%s" is closed.', log_path)
 
 
+class LogFollower:
+    """ Reads lines appended to the active log, like tail -F.
+
+    If the log is rotated (a new file appears under the same name), the
+    rest of the old file is read and the new file is followed from the
+    beginning. If the log is truncated, it is read from the beginning.
+    """
+
+    def __init__(self, log_path, block_size=BLOCK_SIZE):
+        self.log_path = log_path
+        self.block_size = block_size
+        self.file = None
+        self.inode = None
+        self.pending = b''
+
+    def _open(self):
+        try:
+            self.file = open(self.log_path, 'rb', buffering=0)
+        except FileNotFoundError:
+            return False
+        stat = os.fstat(self.file.fileno())
+        self.inode = (stat.st_dev, stat.st_ino)
+        self.pending = b''
+        logging.info('Follow file %s', self.log_path)
+        return True
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _check_rotation(self):
+        """ Called at the end of the file. Returns the last line of the
+        old file if it was rotated and did not end with a newline.
+        """
+        try:
+            stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            # Rotated, but the new file is not created yet.
+            return []
+        if (stat.st_dev, stat.st_ino) != self.inode:
+            logging.info('File %s was rotated', self.log_path)
+            lines = [self.pending] if self.pending else []
+            self.close()
+            self._open()
+            return lines
+        if stat.st_size < self.file.tell():
+            logging.info('File %s was truncated', self.log_path)
+            self.file.seek(0)
+            self.pending = b''
+        return []
+
+    def read(self):
+        """ Returns complete lines from at most one new block of the log.
+        Returns empty list if there is nothing new.
+        """
+        if self.file is None and not self._open():
+            return []
+        block = self.file.read(self.block_size)
+        if not block:
+            return self._check_rotation()
+        lines = (self.pending + block).split(b'\n')
+        self.pending = lines.pop()
+        return lines
+
+
+UI_SHORT_COLUMNS = {
+    'remote_addr': r'[\d\.]+',
+    'remote_user': r'\S*',
+    'http_x_real_ip': r'\S*',
+    'time_local': r'\[.*?\]',
+    'request': r'"(?:GET|POST|HEAD|PUT|DELETE) \S+ \S+"',
+    'status': r'\d+',
+    'body_bytes_sent': r'\d+',
+    'http_referer': r'".*?"',
+    'http_user_agent': r'".*?"',
+    'http_x_forwarded_for': r'".*?"',
+    'http_X_REQUEST_ID': r'".*?"',
+    'http_X_RB_USER': r'".*?"',
+    'request_time': r'\d+\.\d+',
+}
+
+# Value which does not start or end with chars stripped by parse_columns.
+_UNSTRIPPED = r'(?![\[\]" ]){}(?<![\[\]" ])'
+
+# The same columns in one regexp. It accepts columns separated by one
+# space, except the two spaces after remote_user which the ui_short
+# log_format has: parse_columns loses its place after more whitespace.
+# Other lines (bad or unusual ones, e.g. with tabs or extra spaces) are
+# passed to parse_columns, so the result is the same.
+UI_SHORT_REGEXP = ' '.join((
+    r'(?P<remote_addr>[\d\.]+)',
+    r'(?P<remote_user>%s) ?' % _UNSTRIPPED.format(r'\S*'),
+    r'(?P<http_x_real_ip>%s)' % _UNSTRIPPED.format(r'\S*'),
+    r'\[(?P<time_local>%s)\]' % _UNSTRIPPED.format(r'[^\]\n]*'),
+    r'"(?P<request>%s)"' % _UNSTRIPPED.format(
+        r'(?:GET|POST|HEAD|PUT|DELETE) \S+ \S+'),
+    r'(?P<status>\d+)',
+    r'(?P<body_bytes_sent>\d+)',
+    r'"(?P<http_referer>%s)"' % _UNSTRIPPED.format(r'[^"\n]*'),
+    r'"(?P<http_user_agent>%s)"' % _UNSTRIPPED.format(r'[^"\n]*'),
+    r'"(?P<http_x_forwarded_for>%s)"' % _UNSTRIPPED.format(r'[^"\n]*'),
+    r'"(?P<http_X_REQUEST_ID>%s)"' % _UNSTRIPPED.format(r'[^"\n]*'),
+    r'"(?P<http_X_RB_USER>%s)"' % _UNSTRIPPED.format(r'[^"\n]*'),
+    r'(?P<request_time>\d+\.\d+)',
+))
+
+COLUMN_TYPES = {
+    'status': int,
+    'body_bytes_sent': int,
+    'request_time': float,
+}
+
+
 def convert_col_type(col, value):
-    if col in ('status', 'body_bytes_sent'):
-        value = int(value)
-    elif col == 'request_time':
-        value = float(value)
+    convert = COLUMN_TYPES.get(col)
+    if convert:
+        value = convert(value)
     return value
 
 
-def parse_line(line: str):
-    """ Parses one line from log. Returns dict. """
-    if not isinstance(line, str):
-        raise TypeError('line must be a string, but get %s' % type(line))
+class ParseError(ValueError):
+    """ Line cannot be parsed. column is the name of the bad column or None
+    if it is unknown.
+    """
 
-    cols_regexp = {
-        'remote_addr': r'[\d\.]+',
-        'remote_user': r'\S*',
-        'http_x_real_ip': r'\S*',
-        'time_local': r'\[.*?\]',
-        'request': r'"(?:GET|POST|HEAD|PUT|DELETE) \S+ \S+"',
-        'status': r'\d+',
-        'body_bytes_sent': r'\d+',
-        'http_referer': r'".*?"',
-        'http_user_agent': r'".*?"',
-        'http_x_forwarded_for': r'".*?"',
-        'http_X_REQUEST_ID': r'".*?"',
-        'http_X_RB_USER': r'".*?"',
-        'request_time': r'\d+\.\d+',
-    }
+    def __init__(self, msg, column=None):
+        super().__init__(msg)
+        self.column = column
+
+
+class ParseCounters:
+    """ Counts lines and parse errors of a log.
+
+    Errors are counted by column. Only the first `samples` errors of every
+    column are logged and kept as examples. If errors_threshold and
+    log_size (bytes of the whole log file, compressed for gzip logs) are
+    set, parsing is stopped without reading the rest as soon as errors
+    are more than errors_threshold percent of the estimated number of
+    lines of the log. Lines are estimated by bytes per line of at least
+    `warmup` read lines, counted from byte start.
+    """
+    __slots__ = ('total', 'errors', 'columns', 'examples',
+                 'errors_threshold', 'warmup', 'samples', 'log_size',
+                 'start')
+
+    def __init__(self, errors_threshold=None, warmup=0, samples=3,
+                 log_size=None, start=0):
+        self.total = 0
+        self.errors = 0
+        self.columns = {}
+        self.examples = {}
+        self.errors_threshold = errors_threshold
+        self.warmup = warmup
+        self.samples = samples
+        self.log_size = log_size
+        self.start = start
+
+    def error(self, err, position=None):
+        """ Counts a parse error. position is the byte of the log file
+        after the bad line, or a smaller one if it is not known exactly.
+        Raises RuntimeError if the threshold cannot be met with the
+        estimated number of lines of the log, even if the rest of them are
+        good.
+        """
+        self.errors += 1
+        column = getattr(err, 'column', None) or 'line'
+        count = self.columns[column] = self.columns.get(column, 0) + 1
+        if count <= self.samples:
+            self.examples.setdefault(column, []).append(str(err)[:500])
+            logging.error(err)
+            if count == self.samples:
+                logging.warning(
+                    'Further errors in %s are only counted', column)
+        if (self.errors_threshold is not None and self.warmup
+                and self.log_size and position is not None
+                and position > self.start and self.total >= self.warmup):
+            lines = self.total * self.log_size / (position - self.start)
+            if self.errors * 100 > self.errors_threshold * lines:
+                raise RuntimeError(
+                    'Too many errors (%s in first %s lines, more than %s%% '
+                    'of about %d lines) in the analyzed file.' % (
+                        self.errors, self.total, self.errors_threshold,
+                        lines))
 
+    def check(self, errors_threshold):
+        """ Logs counts of errors by column and checks the threshold. """
+        if self.errors:
+            logging.error(
+                'Parse errors: %s of %s lines (%s)', self.errors, self.total,
+                ', '.join('%s: %s' % item for item in
+                          sorted(self.columns.items())))
+        check_errors(self.total, self.errors, errors_threshold)
+
+    def merge(self, other):
+        self.total += other.total
+        self.errors += other.errors
+        for column, count in other.columns.items():
+            self.columns[column] = self.columns.get(column, 0) + count
+        for column, examples in other.examples.items():
+            own = self.examples.setdefault(column, [])
+            own.extend(examples[:self.samples - len(own)])
+
+
+def parse_columns(line: str, cols_regexp: dict):
+    """ Parses line column by column. Slow, but finds the bad column. """
     parsed_dict = {}
     start = 0
 
@@ -122,68 +797,1407 @@ def parse_line(line: str):
 
         if not match:
             msg = "Cannot parse %s in line '%s'" % (col, line.strip())
-            logging.error(msg)
-            raise ValueError(msg)
+            raise ParseError(msg, col)
 
         start += match.end() + 1
         value = match.group().strip('[]"" ')
-        value = convert_col_type(col, value)
+        try:
+            value = convert_col_type(col, value)
+        except ValueError as err:
+            raise ParseError(str(err), col)
         parsed_dict[col] = value
 
     return parsed_dict
 
 
-@log_time_execution
-def parse_log(log_path, errors_threshold):
-    total = 0
-    errors = 0
+class LogParser:
+    """ Parses log lines with one precompiled regexp.
+
+    Named groups of the regexp become keys of the parsed dict. If the
+    regexp does not match, fallback (if any) is called with the line.
+    Bytes lines are matched with the same regexp compiled for bytes.
+    """
+
+    def __init__(self, regexp, fallback=None):
+        self.regexp = re.compile(regexp)
+        self.bytes_regexp = re.compile(regexp.encode())
+        self.fallback = fallback
+        self.converters = tuple(
+            (col, COLUMN_TYPES[col]) for col in self.regexp.groupindex
+            if col in COLUMN_TYPES
+        )
+
+    def parse(self, line):
+        """ Parses one line. Returns dict or raises ValueError. """
+        match = self.regexp.match(line)
+        if match is None:
+            if self.fallback:
+                return self.fallback(line)
+            msg = "Cannot parse line '%s'" % line.strip()
+            raise ParseError(msg)
+        parsed_dict = match.groupdict()
+        for col, convert in self.converters:
+            parsed_dict[col] = convert(parsed_dict[col])
+        return parsed_dict
+
+    def url_time(self, line, start=0, end=sys.maxsize):
+        """ Returns (url, request_time) of bytes line or of its [start, end)
+        part if line is a buffer with many lines (e.g. mmap). Only the URL
+        is decoded, other columns are not even copied.
+        """
+        match = self.bytes_regexp.match(line, start, end)
+        if match is None:
+            parsed_dict = self.parse(
+                line[start:end].decode('utf-8', errors='replace'))
+            request = parsed_dict['request']
+            req_time = parsed_dict['request_time']
+        else:
+            request, req_time = match.group('request', 'request_time')
+            req_time = float(req_time)
+        return request_url(request), req_time
+
+    def fields(self, line, start=0, end=sys.maxsize, columns=()):
+        """ Like url_time, but returns (url, request_time, values) where
+        values are strings of the columns.
+        """
+        match = self.bytes_regexp.match(line, start, end)
+        if match is None:
+            parsed_dict = self.parse(
+                line[start:end].decode('utf-8', errors='replace'))
+            request = parsed_dict['request']
+            req_time = parsed_dict['request_time']
+            values = tuple(str(parsed_dict[col]) for col in columns)
+        else:
+            request, req_time = match.group('request', 'request_time')
+            req_time = float(req_time)
+            values = tuple(
+                match.group(col).decode('utf-8', errors='replace')
+                for col in columns)
+        return request_url(request), req_time, values
+
+
+def request_url(request):
+    """ Returns URL of request line (str or bytes) as str. """
+    parts = request.split()
+    if len(parts) < 2:
+        msg = "Cannot find URL in request '%s'" % request
+        raise ParseError(msg, 'request')
+    url = parts[1]
+    if isinstance(url, bytes):
+        url = url.decode('utf-8', errors='replace')
+    return url
+
+
+def record_reader(parser, columns=()):
+    """ Returns parser.url_time or, if columns are given, function of the
+    same arguments which returns (url, request_time, values).
+    """
+    if not columns:
+        return parser.url_time
+    return functools.partial(parser.fields, columns=columns)
+
+
+UI_SHORT_PARSER = LogParser(
+    UI_SHORT_REGEXP,
+    fallback=functools.partial(parse_columns, cols_regexp=UI_SHORT_COLUMNS),
+)
+
+
+# Regexps for values of nginx variables. Other variables match everything
+# up to the char which follows them in the log_format.
+VARIABLE_REGEXP = {
+    'status': r'\d+',
+    'body_bytes_sent': r'\d+',
+    'request_time': r'\d+(?:\.\d+)?',
+}
+
+REQUIRED_COLUMNS = ('request', 'request_time')
+
+
+def _split_log_format(log_format):
+    """ Returns body of log_format directive without quotes.
+
+    Accepts both the format itself and nginx config text like
+    "log_format main '$remote_addr ' '$status';".
+    """
+    log_format = log_format.strip().rstrip(';')
+    if log_format.startswith('log_format'):
+        log_format = log_format.split(None, 2)[2]
+    pieces = re.findall(r"'([^']*)'", log_format)
+    if pieces and log_format.startswith("'"):
+        return ''.join(pieces)
+    return log_format
+
+
+def _literal_regexp(literal):
+    return ''.join(
+        r'\s+' if chunk.isspace() else re.escape(chunk)
+        for chunk in re.split(r'(\s+)', literal) if chunk
+    )
+
+
+def _diagnose_line(line, parts):
+    """ Finds the first variable of the format which cannot be parsed.
+    A literal which does not match is blamed on the variable before it.
+    """
+    bad_col = next(col for col, _ in parts if col)
+    for i, (col, _) in enumerate(parts):
+        regexp = ''.join(part for _, part in parts[:i + 1])
+        if col:
+            bad_col = col
+        if not re.match(regexp, line):
+            break
+    msg = "Cannot parse %s in line '%s'" % (bad_col, line.strip())
+    raise ParseError(msg, bad_col)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_log_format(log_format: str):
+    """ Compiles nginx log_format into LogParser. """
+    log_format = _split_log_format(log_format)
+    parts = [(None, r'\s*')]
+    pos = 0
+    tokens = list(re.finditer(r'\$(?:\{(\w+)\}|(\w+))', log_format))
+    if not tokens:
+        raise ValueError('No variables in log_format "%s"' % log_format)
+    for i, token in enumerate(tokens):
+        literal = log_format[pos:token.start()]
+        if literal:
+            parts.append((None, _literal_regexp(literal)))
+        pos = token.end()
+        col = token.group(1) or token.group(2)
+        next_char = log_format[pos:pos + 1]
+        if col in VARIABLE_REGEXP:
+            value_regexp = VARIABLE_REGEXP[col]
+        elif not next_char or next_char.isspace() or next_char == '$':
+            value_regexp = r'\S*'
+        else:
+            value_regexp = r'[^%s\n]*' % re.escape(next_char)
+        parts.append((col, '(?P<%s>%s)' % (col, value_regexp)))
+    if log_format[pos:]:
+        parts.append((None, _literal_regexp(log_format[pos:])))
+
+    regexp = ''.join(part for _, part in parts)
+    return LogParser(
+        regexp,
+        fallback=functools.partial(_diagnose_line, parts=parts),
+    )
+
+
+def get_log_parser(log_format=None):
+    """ Returns parser for log_format or for ui_short if it is not set. """
+    if not log_format:
+        return UI_SHORT_PARSER
+    parser = compile_log_format(log_format)
+    missing = [
+        col for col in REQUIRED_COLUMNS if col not in parser.regexp.groupindex
+    ]
+    if missing:
+        raise ValueError('log_format has no %s' % ', '.join(
+            '$' + col for col in missing))
+    return parser
+
+
+def parse_line(line: str, parser=None):
+    """ Parses one line from log. Returns dict. """
+    if not isinstance(line, str):
+        raise TypeError('line must be a string, but get %s' % type(line))
+    return (parser or UI_SHORT_PARSER).parse(line)
+
+
+def parse_lines(lines, parser, counters):
+    """ Parses lines, skipping bad ones. Counts them in ParseCounters. """
+    for line in lines:
+        counters.total += 1
+        try:
+            yield parse_line(line, parser)
+        except ValueError as err:
+            counters.error(err)
+
+
+def check_errors(total, errors, errors_threshold):
+    errors_perc = errors * 100 / total if total else 0
+    if errors_perc > errors_threshold:
+        raise RuntimeError(
+            'Too many errors (%.2f%%) in the analyzed file.' % errors_perc)
+
+
+def parse_log(log_path, errors_threshold, log_format=None, errors_warmup=0):
+    counters = ParseCounters(errors_threshold, errors_warmup)
+    parser = get_log_parser(log_format)
 
     logging.info('Start parsing file %s' % log_path)
-    for line in read_lines(log_path):
-        total += 1
+    yield from parse_lines(read_lines(log_path), parser, counters)
+    logging.info('End of parsing file.')
+
+    counters.check(errors_threshold)
+
+
+def parse_url_times(lines, parser, counters, columns=(), progress=None):
+    """ Like parse_lines, but for bytes lines. Yields (url, request_time)
+    or (url, request_time, values) if columns are given. progress is of
+    read_byte_lines for estimates of ParseCounters.
+    """
+    url_time = record_reader(parser, columns)
+    for line in lines:
+        counters.total += 1
         try:
-            yield parse_line(line)
+            yield url_time(line)
         except ValueError as err:
-            errors += 1
-            continue
+            counters.error(err, read_position(progress))
+
+
+def read_position(progress):
+    """ Returns byte of the compressed log which the parsed lines surely
+    reach, or None if it is unknown. Read ahead bytes are not counted, so
+    lines of the log are never underestimated.
+    """
+    if progress is None:
+        return None
+    return progress.get('position', 0) - READ_AHEAD
+
+
+def scan_mapped_lines(log_path, parser, counters, start=0, end=None,
+                      columns=()):
+    """ Yields (url, request_time) of lines of plain log which begin in
+    [start, end). The file is memory-mapped and lines are matched in
+    place, without copying them. See parse_url_times for columns.
+    """
+    if not os.path.getsize(log_path):
+        return
+    url_time = record_reader(parser, columns)
+    with open(log_path, 'rb') as log, \
+            mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        size = len(buf)
+        end = size if end is None else end
+        find = buf.find
+        pos = start
+        while pos < end:
+            eol = find(b'\n', pos)
+            if eol < 0:
+                eol = size
+            counters.total += 1
+            try:
+                yield url_time(buf, pos, eol)
+            except ValueError as err:
+                counters.error(err, eol + 1)
+            pos = eol + 1
+
 
+def scan_log(log_path, errors_threshold, log_format=None, decompressor=None,
+             metrics=None, errors_warmup=0, columns=()):
+    """ Yields (url, request_time) of lines of the log. Plain logs are
+    memory-mapped, gzip logs are read in blocks of bytes. Checks errors
+    like parse_log. Counters are added to metrics if it is given.
+    """
+    counters = ParseCounters(errors_threshold, errors_warmup,
+                             log_size=os.path.getsize(log_path))
+    parser = get_log_parser(log_format)
+
+    logging.info('Start parsing file %s' % log_path)
+    try:
+        if log_path.endswith('.gz'):
+            progress = {}
+            lines = read_byte_lines(log_path, decompressor, metrics,
+                                    progress)
+            yield from parse_url_times(lines, parser, counters, columns,
+                                       progress)
+        else:
+            yield from scan_mapped_lines(log_path, parser, counters,
+                                         columns=columns)
+    finally:
+        # Also after early abort, so the run summary shows the errors.
+        if metrics is not None:
+            metrics.counters['bytes_read'] += os.path.getsize(log_path)
+            metrics.add_parse_counters(counters)
     logging.info('End of parsing file.')
 
-    errors_perc = errors * 100 / total
-    if errors_perc > errors_threshold:
-        raise RuntimeError('Тoo many errors (%.2f%) in the analyzed file.',
-                           errors_perc)
+    counters.check(errors_threshold)
+
+
+def scan_log_segments(log_path, parser, counters, progress, segment_bytes,
+                      decompressor=None, metrics=None, columns=()):
+    """ Yields (url, request_time) iterators of consecutive parts of the
+    log, each about segment_bytes of (decompressed) data ending on a line
+    boundary. Reading starts at progress['offset']. When a part is
+    consumed, progress['offset'] is its end and progress['eof'] tells if
+    the log is over. Plain logs start at the offset at once, gzip logs are
+    decompressed from the beginning, but skipped lines are not parsed.
+    """
+    if not log_path.endswith('.gz'):
+        size = os.path.getsize(log_path)
+
+        def mapped_segment(start, end):
+            yield from scan_mapped_lines(log_path, parser, counters, start,
+                                         end, columns)
+            progress['offset'] = end
+            progress['eof'] = end >= size
+
+        pos = progress['offset']
+        if pos >= size:
+            progress['eof'] = True
+            return
+        with open(log_path, 'rb') as log, \
+                mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            while pos < size:
+                end = buf.find(b'\n', min(pos + segment_bytes, size) - 1)
+                end = end + 1 if end >= 0 else size
+                yield mapped_segment(pos, end)
+                pos = end
+        return
+
+    read_progress = {}
+    lines = read_byte_lines(log_path, decompressor, metrics, read_progress)
+    skipped = 0
+    for line in lines:
+        if skipped >= progress['offset']:
+            lines = itertools.chain((line,), lines)
+            break
+        skipped += len(line) + 1
+
+    def segment():
+        url_time = record_reader(parser, columns)
+        read = 0
+        for line in lines:
+            read += len(line) + 1
+            counters.total += 1
+            try:
+                yield url_time(line)
+            except ValueError as err:
+                counters.error(err, read_position(read_progress))
+            if read >= segment_bytes:
+                break
+        else:
+            progress['eof'] = True
+        progress['offset'] += read
+
+    while not progress['eof']:
+        yield segment()
+
+
+# Built-in rules for URL_RULES: regexp of a path segment and replacement.
+URL_RULES = {
+    'numeric': (r'(?<=/)\d+(?=/|$)', '{id}'),
+    'uuid': (r'(?<=/)[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+             r'[0-9a-fA-F]{4}-[0-9a-fA-F]{12}(?=/|$)', '{uuid}'),
+}
 
+OVERFLOW_URL = '(other)'
 
-def collect_time_data(log):
-    time_data = {
+
+class UrlNormalizer:
+    """ Turns raw URLs into aggregation keys.
+
+    rules are names of URL_RULES or (regexp, replacement) pairs applied to
+    the path. They are compiled into one regexp with a named group per
+    rule. query_params is None to keep the query string as is, otherwise
+    only the listed params are kept. After max_urls different keys all
+    new URLs go to OVERFLOW_URL. Results for raw URLs are cached.
+    """
+
+    def __init__(self, rules=(), query_params=None, max_urls=None,
+                 cache_size=65536):
+        self.replacements = {}
+        patterns = []
+        for index, rule in enumerate(rules):
+            if isinstance(rule, str):
+                if rule not in URL_RULES:
+                    raise RuntimeError('Unknown URL rule %s' % rule)
+                rule = URL_RULES[rule]
+            regexp, replacement = rule
+            name = '_rule%d' % index
+            self.replacements[name] = replacement
+            patterns.append('(?P<%s>%s)' % (name, regexp))
+        try:
+            self.regexp = re.compile('|'.join(patterns)) if patterns else None
+        except re.error as err:
+            raise RuntimeError('Bad URL rule: %s' % err)
+        self.query_params = (
+            None if query_params is None else frozenset(query_params))
+        self.max_urls = max_urls
+        self.urls = set()
+        self.normalize_raw = functools.lru_cache(cache_size)(self._normalize)
+
+    def _replace(self, match):
+        return self.replacements[match.lastgroup]
+
+    def _normalize(self, url):
+        path, question, query = url.partition('?')
+        if self.regexp is not None:
+            path = self.regexp.sub(self._replace, path)
+        if self.query_params is not None:
+            query = '&'.join(
+                param for param in query.split('&')
+                if param.partition('=')[0] in self.query_params)
+            question = '?' if query else ''
+        return path + question + query
+
+    def normalize(self, url):
+        url = self.normalize_raw(url)
+        if self.max_urls and url not in self.urls:
+            if len(self.urls) >= self.max_urls:
+                return OVERFLOW_URL
+            self.urls.add(url)
+        return url
+
+
+def url_options(config):
+    """ Returns options of UrlNormalizer from config. """
+    return {
+        'rules': config.get('URL_RULES') or [],
+        'query_params': config.get('QUERY_PARAMS'),
+        'max_urls': config.get('MAX_URLS'),
+    }
+
+
+def get_url_normalizer(options=None):
+    """ Returns UrlNormalizer or None if URLs are used as is. """
+    options = options or {}
+    if not (options.get('rules') or options.get('max_urls')
+            or options.get('query_params') is not None):
+        return None
+    return UrlNormalizer(**options)
+
+
+def normalize_url_times(url_times, normalizer=None):
+    """ Yields (url, request_time) with normalized URLs. """
+    if normalizer is None:
+        yield from url_times
+        return
+    normalize = normalizer.normalize
+    for url, req_time in url_times:
+        yield normalize(url), req_time
+
+
+def _status_class(value):
+    return value[:1] + 'xx'
+
+
+# Dimensions for BREAKDOWNS: column of the log, function of normalized URL
+# and value of the column which returns the key, names of key fields in
+# the report and order of rows: by 'key', by 'time' or top by 'time_sum'
+# or 'count'.
+BREAKDOWNS = {
+    'status': ('status', lambda url, value: _status_class(value),
+               ('status',), 'key'),
+    'url_status': ('status',
+                   lambda url, value: (url, _status_class(value)),
+                   ('url', 'status'), 'time_sum'),
+    'minute': ('time_local', lambda url, value: value[:17], ('time',),
+               'time'),
+    'hour': ('time_local', lambda url, value: value[:14], ('time',), 'time'),
+    'client': ('remote_addr', lambda url, value: value, ('client',),
+               'count'),
+}
+
+# Formats of time_local prefixes used as keys of minute and hour.
+BREAKDOWN_TIME_FORMATS = {
+    'minute': ('%d/%b/%Y:%H:%M', '%Y-%m-%d %H:%M'),
+    'hour': ('%d/%b/%Y:%H', '%Y-%m-%d %H:00'),
+}
+
+
+def breakdown_columns(names, parser=None):
+    """ Returns columns of the log which breakdowns need. """
+    columns = []
+    for name in names:
+        if name not in BREAKDOWNS:
+            raise RuntimeError('Unknown breakdown %s' % name)
+        column = BREAKDOWNS[name][0]
+        if parser is not None and column not in parser.regexp.groupindex:
+            raise ValueError('log_format has no $%s for breakdown %s' % (
+                column, name))
+        if column not in columns:
+            columns.append(column)
+    return tuple(columns)
+
+
+def count_breakdowns(records, breakdowns, names, normalizer=None):
+    """ Counts (url, request_time, values) records in breakdowns: for every
+    name, a dict of key -> [count, time sum in microseconds, time max].
+    Yields (url, request_time). values are of breakdown_columns(names).
+    Returns records as is if there are no names.
+    """
+    if not names:
+        return records
+    columns = breakdown_columns(names)
+    plan = [
+        (breakdowns.setdefault(name, {}),
+         columns.index(BREAKDOWNS[name][0]), BREAKDOWNS[name][1])
+        for name in names
+    ]
+    normalize = normalizer.normalize if normalizer is not None else None
+    return _count_breakdowns(records, plan, normalize)
+
+
+def _count_breakdowns(records, plan, normalize):
+    for url, req_time, values in records:
+        key_url = normalize(url) if normalize is not None else url
+        for counts, index, make_key in plan:
+            key = make_key(key_url, values[index])
+            entry = counts.get(key)
+            if entry is None:
+                counts[key] = [1, round(req_time * TIME_TICKS), req_time]
+            else:
+                entry[0] += 1
+                entry[1] += round(req_time * TIME_TICKS)
+                if req_time > entry[2]:
+                    entry[2] = req_time
+        yield url, req_time
+
+
+def merge_breakdowns(breakdowns, other):
+    """ Adds counts of other breakdowns to breakdowns. """
+    for name, other_counts in other.items():
+        counts = breakdowns.setdefault(name, {})
+        for key, (count, time_ticks, time_max) in other_counts.items():
+            entry = counts.get(key)
+            if entry is None:
+                counts[key] = [count, time_ticks, time_max]
+            else:
+                entry[0] += count
+                entry[1] += time_ticks
+                entry[2] = max(entry[2], time_max)
+    return breakdowns
+
+
+def _breakdown_time(name, key):
+    """ Returns (datetime, text) of minute or hour key, or (None, key) if
+    time_local has another format.
+    """
+    parse_format, text_format = BREAKDOWN_TIME_FORMATS[name]
+    try:
+        moment = datetime.strptime(key, parse_format)
+    except ValueError:
+        return None, key
+    return moment, moment.strftime(text_format)
+
+
+def breakdown_tables(breakdowns, requests_count, total_time_sum,
+                     report_size=None, round_digits=3):
+    """ Returns rows of every breakdown for the report. Top breakdowns
+    (URL and status, clients) are cut to report_size rows.
+    """
+    tables = {}
+    total_time_sum = round(total_time_sum, 3)
+    for name, counts in breakdowns.items():
+        _, _, fields, order = BREAKDOWNS[name]
+        items = counts.items()
+        if order == 'key':
+            items = sorted(items)
+        elif order == 'time':
+            times = {key: _breakdown_time(name, key) for key in counts}
+            items = sorted(items, key=lambda item: (
+                times[item[0]][0] is None, times[item[0]][0] or item[0]))
+        else:
+            scale = TIME_TICKS if order == 'time_sum' else 1
+            position = 1 if order == 'time_sum' else 0
+            items = heapq.nlargest(
+                report_size or len(counts), items,
+                key=lambda item: round(item[1][position] / scale,
+                                       round_digits))
+        rows = []
+        for key, (count, time_ticks, time_max) in items:
+            if order == 'time':
+                key = times[key][1]
+            time_sum = time_ticks / TIME_TICKS
+            time_perc = time_sum / total_time_sum if total_time_sum else 0
+            row = dict(zip(fields, key if len(fields) > 1 else (key,)))
+            row.update({
+                'count': count,
+                'count_perc': round(count * 100 / requests_count,
+                                    round_digits),
+                'time_sum': round(time_sum, round_digits),
+                'time_perc': round(time_perc, round_digits),
+                'time_avg': round(time_sum / count, round_digits),
+                'time_max': time_max,
+            })
+            rows.append(row)
+        tables[name] = rows
+    return tables
+
+
+# Sums of times which are merged (of sketches and breakdowns) are kept in
+# integer microseconds. Unlike float sums they do not depend on how the
+# log is split between workers. nginx writes times in milliseconds, so
+# the sums are exact.
+TIME_TICKS = 1000000
+
+
+@functools.lru_cache(maxsize=None)
+def _sketch_gamma(relative_error):
+    gamma = (1 + relative_error) / (1 - relative_error)
+    return gamma, math.log(gamma)
+
+
+class TimeSketch:
+    """ Count, sum and max of request times and a DDSketch-like histogram
+    for quantiles.
+
+    Times are counted in logarithmic buckets, so any quantile is
+    estimated with relative error not greater than relative_error. Memory
+    depends on the range of times, not on their number. Sketches with the
+    same relative_error can be merged.
+    """
+    __slots__ = ('relative_error', 'count', 'time_ticks', 'time_max',
+                 'zero_count', 'bins', '_log_gamma')
+
+    # Times less than this are counted as zero.
+    min_time = 1e-6
+
+    def __init__(self, relative_error=0.01):
+        if not 0 < relative_error < 1:
+            raise ValueError('relative_error must be in (0, 1)')
+        self.relative_error = relative_error
+        self.count = 0
+        self.time_ticks = 0
+        self.time_max = 0.0
+        self.zero_count = 0
+        self.bins = {}
+        self._log_gamma = _sketch_gamma(relative_error)[1]
+
+    def add(self, value):
+        self.count += 1
+        self.time_ticks += round(value * TIME_TICKS)
+        if value > self.time_max:
+            self.time_max = value
+        if value < self.min_time:
+            self.zero_count += 1
+        else:
+            key = math.ceil(math.log(value) / self._log_gamma)
+            self.bins[key] = self.bins.get(key, 0) + 1
+
+    def merge(self, other):
+        if other.relative_error != self.relative_error:
+            raise ValueError('Cannot merge sketches with different errors')
+        self.count += other.count
+        self.time_ticks += other.time_ticks
+        self.time_max = max(self.time_max, other.time_max)
+        self.zero_count += other.zero_count
+        bins = self.bins
+        for key, count in other.bins.items():
+            bins[key] = bins.get(key, 0) + count
+        return self
+
+    @property
+    def time_sum(self):
+        return self.time_ticks / TIME_TICKS
+
+    def quantile(self, q):
+        return self.quantiles((q,))[0]
+
+    def median(self):
+        """ Like statistics.median, the mean of the two middle times for
+        even count.
+        """
+        return self.quantiles((0.5,))[0]
+
+    def quantiles(self, qs):
+        """ Returns quantiles for qs, interpolated between times of
+        neighbour ranks as sorted_quantile does for exact times.
+        """
+        if not self.count:
+            raise ValueError('quantile of empty sketch')
+        last = self.count - 1
+        ranks = [q * last for q in qs]
+        times = self._rank_times(sorted(
+            {int(rank) for rank in ranks}
+            | {min(int(rank) + 1, last) for rank in ranks}))
+        result = []
+        for rank in ranks:
+            low = times[int(rank)]
+            high = times[min(int(rank) + 1, last)]
+            result.append(low + (high - low) * (rank - int(rank)))
+        return result
+
+    def _rank_times(self, ranks):
+        """ Returns {rank: time} for sorted ranks in one pass over the
+        bins.
+        """
+        gamma = _sketch_gamma(self.relative_error)[0]
+        times = {}
+        seen = self.zero_count
+        keys = iter(sorted(self.bins))
+        time = 0.0
+        for rank in ranks:
+            while seen <= rank:
+                key = next(keys)
+                seen += self.bins[key]
+                time = min(2 * gamma ** key / (gamma + 1), self.time_max)
+            times[rank] = time
+        return times
+
+
+@functools.lru_cache(maxsize=None)
+def get_numpy():
+    """ Imports numpy on first use, so runs with python backend do not
+    pay for it. Returns the module or None if it is not installed.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def new_time_data(backend='python'):
+    """ Returns empty time_data. For numpy backend URLs get integer ids in
+    order of appearance, ids (32 bit) and times of requests are kept in
+    arrays.
+    """
+    if backend == 'numpy':
+        return {
+            'total_time_sum': 0,
+            'requests_count': 0,
+            'urls': {},
+            'url_ids': array.array('i'),
+            'times': array.array('d'),
+        }
+    return {
         'total_time_sum': 0,
         'requests_count': 0,
         'items': {},
     }
-    for line in log:
-        req_time = line.get('request_time')
-        url = line.get('request').split()[1]
+
+
+def update_time_data(time_data, log, median_error=None):
+    """ Adds parsed lines to time_data. """
+    url_times = (
+        (line.get('request').split()[1], line.get('request_time'))
+        for line in log
+    )
+    return add_url_times(time_data, url_times, median_error)
+
+
+def add_url_times(time_data, url_times, median_error=None):
+    """ Adds (url, request_time) pairs to time_data. Times of every URL
+    are kept in array of doubles if median_error is None, otherwise in
+    TimeSketch.
+    """
+    if 'times' in time_data:
+        return add_columnar_url_times(time_data, url_times)
+    items = time_data['items']
+    for url, req_time in url_times:
+        time_data['total_time_sum'] += req_time
+        time_data['requests_count'] += 1
+        times = items.get(url)
+        if times is None:
+            times = items[url] = (array.array('d') if median_error is None
+                                  else TimeSketch(median_error))
+        if median_error is None:
+            times.append(req_time)
+        else:
+            times.add(req_time)
+    return time_data
+
+
+def add_columnar_url_times(time_data, url_times):
+    urls = time_data['urls']
+    url_ids = time_data['url_ids']
+    times = time_data['times']
+    for url, req_time in url_times:
         time_data['total_time_sum'] += req_time
         time_data['requests_count'] += 1
-        time_data['items'].setdefault(url, []).append(req_time)
+        url_id = urls.get(url)
+        if url_id is None:
+            url_id = urls[url] = len(urls)
+        url_ids.append(url_id)
+        times.append(req_time)
+    return time_data
+
+
+def merge_time_data(time_data, other):
+    """ Adds other time_data to time_data. Times of other go after the
+    times of time_data, so merging parts of a log in order gives
+    the same lists as collecting the whole log.
+    """
+    time_data['total_time_sum'] += other['total_time_sum']
+    time_data['requests_count'] += other['requests_count']
+    if 'breakdowns' in other:
+        merge_breakdowns(time_data.setdefault('breakdowns', {}),
+                         other['breakdowns'])
+    if 'times' in time_data:
+        return merge_columnar_data(time_data, other)
+    items = time_data['items']
+    for url, times in other['items'].items():
+        if isinstance(times, TimeSketch):
+            own = items.get(url)
+            if own is None:
+                own = items[url] = TimeSketch(times.relative_error)
+            own.merge(times)
+        else:
+            own = items.get(url)
+            if own is None:
+                own = items[url] = array.array('d')
+            own.extend(times)
+    return time_data
+
+
+def cap_urls(time_data, max_urls):
+    """ Folds times of URLs after the first max_urls into OVERFLOW_URL, as
+    UrlNormalizer does while parsing. For time_data merged in order from
+    parts of a log parsed without the limit.
+    """
+    urls = list(time_data['urls'] if 'times' in time_data
+                else time_data['items'])
+    if len(urls) <= max_urls:
+        return time_data
+    overflow = set(urls[max_urls:])
+    if 'times' in time_data:
+        # URL ids are given in order of appearance.
+        numpy = get_numpy()
+        id_map = numpy.minimum(numpy.arange(len(urls)), max_urls)
+        url_ids = numpy.frombuffer(time_data['url_ids'], dtype=numpy.int32)
+        time_data['url_ids'] = array.array('i')
+        time_data['url_ids'].frombytes(
+            id_map.astype(numpy.int32)[url_ids].tobytes())
+        time_data['urls'] = {url: url_id for url_id, url
+                             in enumerate(urls[:max_urls] + [OVERFLOW_URL])}
+    else:
+        items = time_data['items']
+        time_data['items'] = {url: items[url] for url in urls[:max_urls]}
+        for url in urls[max_urls:]:
+            merge_time_data(time_data, {
+                'total_time_sum': 0,
+                'requests_count': 0,
+                'items': {OVERFLOW_URL: items[url]},
+            })
+    for name, counts in time_data.get('breakdowns', {}).items():
+        fields = BREAKDOWNS[name][2]
+        if 'url' not in fields:
+            continue
+        index = fields.index('url')
+        capped = {name: {}}
+        for key, entry in counts.items():
+            if key[index] in overflow:
+                key = key[:index] + (OVERFLOW_URL,) + key[index + 1:]
+            merge_breakdowns(capped, {name: {key: entry}})
+        time_data['breakdowns'][name] = capped[name]
+    return time_data
+
+
+def merge_columnar_data(time_data, other):
+    numpy = get_numpy()
+    urls = time_data['urls']
+    id_map = numpy.array(
+        [urls.setdefault(url, len(urls)) for url in other['urls']],
+        dtype=numpy.int32,
+    )
+    other_ids = numpy.frombuffer(other['url_ids'], dtype=numpy.int32)
+    time_data['url_ids'].frombytes(id_map[other_ids].tobytes())
+    time_data['times'].extend(other['times'])
+    return time_data
+
+
+def collect_time_data(log, median_error=None, backend='python'):
+    time_data = update_time_data(new_time_data(backend), log, median_error)
     time_data['total_time_sum'] = round(time_data['total_time_sum'], 3)
     return time_data
 
 
+def aggregate_url_times(time_data, url_times, median_error=None,
+                        metrics=None):
+    """ Like add_url_times. If metrics is given, pairs are taken in
+    batches, so time of parsing and of aggregation are measured apart.
+    """
+    if metrics is None:
+        return add_url_times(time_data, url_times, median_error)
+    for batch in metrics.batches(url_times, 'parse'):
+        with metrics.timer('aggregate'):
+            add_url_times(time_data, batch, median_error)
+    return time_data
+
+
 @log_time_execution
-def calculate_statistics(log, round_digits=3):
+def collect_url_times(url_times, median_error=None, backend='python',
+                      metrics=None):
+    """ Like collect_time_data, but for (url, request_time) pairs. The
+    total time is not rounded, so the result can be merged exactly.
+    """
+    return aggregate_url_times(
+        new_time_data(backend), url_times, median_error, metrics)
+
+
+AGGREGATE_MAGIC = b'LOGAGG1\n'
+
+
+def time_data_kind(time_data):
+    """ Returns 'columnar', 'lists' or 'sketch' and relative error of
+    sketches (None for other kinds).
+    """
+    if 'times' in time_data:
+        return 'columnar', None
+    times = next(iter(time_data['items'].values()), None)
+    if isinstance(times, TimeSketch):
+        return 'sketch', times.relative_error
+    return 'lists', None
+
+
+def _write_str(stream, value):
+    value = value.encode('utf-8', errors='surrogateescape')
+    stream.write(struct.pack('<I', len(value)))
+    stream.write(value)
+
+
+def _read_str(buf, pos):
+    size, = struct.unpack_from('<I', buf, pos)
+    pos += 4
+    return bytes(buf[pos:pos + size]).decode(
+        'utf-8', errors='surrogateescape'), pos + size
+
+
+def _read_array(buf, pos, typecode, size):
+    values = array.array(typecode)
+    end = pos + size * values.itemsize
+    values.frombytes(buf[pos:end])
+    return values, end
+
+
+def dump_time_data(time_data, path, meta=None):
+    """ Saves time_data to a compact binary file: magic, JSON header
+    with meta and zlib-compressed arrays of numbers. The file is written
+    to a temporary file and renamed, so readers never see a partial one.
+    """
+    kind, relative_error = time_data_kind(time_data)
+    body = io.BytesIO()
+    if kind == 'columnar':
+        body.write(struct.pack('<Q', len(time_data['urls'])))
+        for url in time_data['urls']:
+            _write_str(body, url)
+        body.write(time_data['url_ids'].tobytes())
+        body.write(time_data['times'].tobytes())
+    else:
+        body.write(struct.pack('<Q', len(time_data['items'])))
+        for url, times in time_data['items'].items():
+            _write_str(body, url)
+            if kind == 'lists':
+                body.write(struct.pack('<Q', len(times)))
+                body.write(array.array('d', times).tobytes())
+            else:
+                body.write(struct.pack(
+                    '<QqdQQ', times.count, times.time_ticks, times.time_max,
+                    times.zero_count, len(times.bins)))
+                body.write(array.array('i', times.bins).tobytes())
+                body.write(array.array('q', times.bins.values()).tobytes())
+    breakdowns = time_data.get('breakdowns')
+    if breakdowns is not None:
+        _write_str(body, json.dumps({
+            name: [[key, *entry] for key, entry in counts.items()]
+            for name, counts in breakdowns.items()
+        }))
+
+    header = dict(meta or {})
+    header.update({
+        'kind': kind,
+        'url_id_type': 'i',
+        'time_ticks': TIME_TICKS,
+        'relative_error': relative_error,
+        'byteorder': sys.byteorder,
+        'requests_count': time_data['requests_count'],
+        'total_time_sum': time_data['total_time_sum'],
+        'breakdowns': breakdowns is not None,
+    })
+    header = json.dumps(header).encode()
+    with atomic_write(path, 'wb') as aggregate:
+        aggregate.write(AGGREGATE_MAGIC)
+        aggregate.write(struct.pack('<I', len(header)))
+        aggregate.write(header)
+        aggregate.write(zlib.compress(body.getvalue()))
+
+
+def load_aggregate_header(path):
+    """ Returns JSON header of aggregate file and position of its body or
+    (None, None) if it is not an aggregate file.
+    """
+    with open(path, 'rb') as aggregate:
+        if aggregate.read(len(AGGREGATE_MAGIC)) != AGGREGATE_MAGIC:
+            return None, None
+        size, = struct.unpack('<I', aggregate.read(4))
+        header = json.loads(aggregate.read(size).decode())
+        return header, aggregate.tell()
+
+
+def load_time_data(path):
+    """ Loads time_data saved by dump_time_data. Returns time_data and
+    header.
+    """
+    header, body_pos = load_aggregate_header(path)
+    if header is None:
+        raise ValueError('"%s" is not an aggregate file' % path)
+    with open(path, 'rb') as aggregate:
+        aggregate.seek(body_pos)
+        buf = memoryview(zlib.decompress(aggregate.read()))
+    swap = header['byteorder'] != sys.byteorder
+    kind = header['kind']
+    # Aggregates of older versions keep sums of sketches and breakdowns
+    # in seconds.
+    ticks = header.get('time_ticks')
+    time_data = new_time_data('numpy' if kind == 'columnar' else 'python')
+    time_data['requests_count'] = header['requests_count']
+    time_data['total_time_sum'] = header['total_time_sum']
+
+    urls_count, = struct.unpack_from('<Q', buf, 0)
+    pos = 8
+    if kind == 'columnar':
+        urls = time_data['urls']
+        for url_id in range(urls_count):
+            url, pos = _read_str(buf, pos)
+            urls[url] = url_id
+        count = header['requests_count']
+        # Aggregates of older versions keep ids as 64 bit integers.
+        id_type = header.get('url_id_type', 'q')
+        url_ids, pos = _read_array(buf, pos, id_type, count)
+        times, pos = _read_array(buf, pos, 'd', count)
+        if swap:
+            url_ids.byteswap()
+            times.byteswap()
+        if id_type != 'i':
+            url_ids = array.array('i', url_ids)
+        time_data['url_ids'], time_data['times'] = url_ids, times
+    else:
+        items = time_data['items']
+        for _ in range(urls_count):
+            url, pos = _read_str(buf, pos)
+            if kind == 'lists':
+                count, = struct.unpack_from('<Q', buf, pos)
+                times, pos = _read_array(buf, pos + 8, 'd', count)
+                if swap:
+                    times.byteswap()
+                items[url] = times
+                continue
+            sketch = TimeSketch(header['relative_error'])
+            (sketch.count, sketch.time_ticks, sketch.time_max,
+             sketch.zero_count, bins_count) = struct.unpack_from(
+                '<Q%sdQQ' % ('q' if ticks else 'd'), buf, pos)
+            if not ticks:
+                sketch.time_ticks = round(sketch.time_ticks * TIME_TICKS)
+            keys, pos = _read_array(buf, pos + 40, 'i', bins_count)
+            counts, pos = _read_array(buf, pos, 'q', bins_count)
+            if swap:
+                keys.byteswap()
+                counts.byteswap()
+            sketch.bins = dict(zip(keys, counts))
+            items[url] = sketch
+    if header.get('breakdowns'):
+        breakdowns, pos = _read_str(buf, pos)
+        # JSON has no tuples, keys of several fields come as lists.
+        time_data['breakdowns'] = {
+            name: {
+                tuple(key) if isinstance(key, list) else key: entry
+                for key, *entry in rows
+            }
+            for name, rows in json.loads(breakdowns).items()
+        }
+        if not ticks:
+            for counts in time_data['breakdowns'].values():
+                for entry in counts.values():
+                    entry[1] = round(entry[1] * TIME_TICKS)
+    return time_data, header
+
+
+def save_checkpoint(path, time_data, signature, offset, counters):
+    """ Saves state of parsing at byte offset of the log: time_data and
+    ParseCounters.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    dump_time_data(time_data, path, {
+        'signature': signature,
+        'checkpoint': {
+            'offset': offset,
+            'total': counters.total,
+            'errors': counters.errors,
+            'columns': counters.columns,
+            'examples': counters.examples,
+        },
+    })
+
+
+def load_checkpoint(path, signature, counters):
+    """ Returns time_data and byte offset saved by save_checkpoint and
+    restores counters. Returns (None, 0) if there is no checkpoint for
+    the signature.
+    """
+    try:
+        header, _ = load_aggregate_header(path)
+        if (not header or header.get('signature') != signature
+                or 'checkpoint' not in header):
+            return None, 0
+        time_data, _ = load_time_data(path)
+    except FileNotFoundError:
+        return None, 0
+    except (OSError, ValueError, struct.error, zlib.error) as err:
+        logging.warning('Checkpoint %s is broken: %s', path, err)
+        return None, 0
+    state = header['checkpoint']
+    counters.total = state['total']
+    counters.errors = state['errors']
+    counters.columns = state['columns']
+    counters.examples = state['examples']
+    return time_data, state['offset']
+
+
+def collect_chunk(log_path, start, end, log_format=None, median_error=None,
+                  backend='python', url_options=None, errors_threshold=None,
+                  errors_warmup=0, breakdowns=()):
+    """ Parses part of the log. Returns not rounded time_data,
+    ParseCounters and RunMetrics of the part. Runs in worker processes.
+    """
+    counters = ParseCounters(errors_threshold, errors_warmup,
+                             log_size=os.path.getsize(log_path), start=start)
+    metrics = RunMetrics()
+    parser = get_log_parser(log_format)
+    normalizer = get_url_normalizer(url_options)
+    time_data = new_time_data(backend)
+    if breakdowns:
+        time_data['breakdowns'] = {}
+    records = scan_mapped_lines(log_path, parser, counters, start, end,
+                                breakdown_columns(breakdowns))
+    url_times = normalize_url_times(
+        count_breakdowns(records, time_data.get('breakdowns'), breakdowns,
+                         normalizer),
+        normalizer)
+    try:
+        aggregate_url_times(time_data, url_times, median_error, metrics)
+    except RuntimeError as err:
+        # Pickled with the error, so the summary shows the errors.
+        err.counters = counters
+        err.metrics = metrics
+        raise
+    return time_data, counters, metrics
+
+
+@log_time_execution
+def collect_time_data_parallel(log_path, errors_threshold, workers,
+                               log_format=None, median_error=None,
+                               backend='python', url_options=None,
+                               metrics=None, errors_warmup=0, breakdowns=()):
+    """ Parses plain log in worker processes. Returns the same time_data
+    as collect_url_times(scan_log(...)). Workers do not limit URLs, the
+    limit is applied to the merged time_data, so URLs beyond it are the
+    same as in one process.
+    """
+    chunks = find_chunks(log_path, workers)
+    max_urls = (url_options or {}).get('max_urls')
+    if max_urls:
+        url_options = dict(url_options, max_urls=None)
+    logging.info('Start parsing file %s in %s chunks by %s workers',
+                 log_path, len(chunks), workers)
+    time_data = new_time_data(backend)
+    if breakdowns:
+        time_data['breakdowns'] = {}
+    counters = ParseCounters()
+    log_metrics = RunMetrics()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(collect_chunk, log_path, start, end, log_format,
+                            median_error, backend, url_options,
+                            errors_threshold, errors_warmup, breakdowns)
+            for start, end in chunks
+        ]
+        try:
+            for future in futures:
+                chunk_data, chunk_counters, chunk_metrics = future.result()
+                merge_time_data(time_data, chunk_data)
+                counters.merge(chunk_counters)
+                log_metrics.merge(chunk_metrics)
+        except RuntimeError as err:
+            for future in futures:
+                future.cancel()
+            if hasattr(err, 'counters'):
+                counters.merge(err.counters)
+                log_metrics.merge(err.metrics)
+            raise
+        finally:
+            # Also after early abort, as scan_log does.
+            log_metrics.counters['bytes_read'] += os.path.getsize(log_path)
+            log_metrics.add_parse_counters(counters)
+            if metrics is not None:
+                metrics.merge(log_metrics)
+    logging.info('End of parsing file.')
+
+    counters.check(errors_threshold)
+    if max_urls:
+        cap_urls(time_data, max_urls)
+    return time_data
+
+
+@log_time_execution
+def calculate_statistics(log, round_digits=3, median_error=None,
+                         backend='python', report_size=None):
+    return time_data_statistics(
+        collect_time_data(log, median_error, backend), round_digits,
+        report_size)
+
+
+def summarize_times(times, percentiles=()):
+    """ Returns count, sum, max, median and list of percentiles of times
+    (sequence or TimeSketch). percentiles are sorted numbers from 0 to 100.
+    """
+    qs = [percentile / 100 for percentile in percentiles]
+    if isinstance(times, TimeSketch):
+        return (times.count, times.time_sum, times.time_max, times.median(),
+                times.quantiles(qs))
+    # Times are added in order of the log: sorted ones give another sum.
+    time_sum = sum(times)
+    if qs:
+        # One sort for all percentiles; median() of sorted times is linear.
+        times = sorted(times)
+        quantiles = [sorted_quantile(times, q) for q in qs]
+    else:
+        quantiles = []
+    return len(times), time_sum, max(times), median(times), quantiles
+
+
+def sorted_quantile(times, q):
+    """ Returns q quantile of sorted times with linear interpolation, as
+    median does for q = 0.5.
+    """
+    rank = q * (len(times) - 1)
+    low = int(rank)
+    if low + 1 == len(times):
+        return times[low]
+    return times[low] + (times[low + 1] - times[low]) * (rank - low)
+
+
+def times_sum(times):
+    if isinstance(times, TimeSketch):
+        return times.time_sum
+    return sum(times)
+
+
+def top_urls(url_sums, report_size, round_digits=3):
+    """ Returns report_size (url, time_sum) pairs with the largest rounded
+    time_sum, in the order stats_to_html sorts them. A heap is used, so
+    the pairs are never sorted all together.
+    """
+    return heapq.nlargest(report_size, url_sums,
+                          key=lambda url_sum: round(url_sum[1], round_digits))
+
+
+def _sort_times_by_url(url_ids, times):
+    """ Returns times sorted by URL id and then by time.
+
+    nginx writes request_time with milliseconds resolution, so usually
+    one integer key (URL id and milliseconds) is sorted, which is much
+    faster than lexsort of two arrays.
+    """
+    numpy = get_numpy()
+    millis = numpy.rint(times * 1000)
+    if (len(times) and numpy.array_equal(millis / 1000, times)
+            and 0 <= millis.min() and millis.max() < 2 ** 31):
+        base = int(millis.max()) + 1
+        keys = (url_ids.astype(numpy.int64) * base
+                + millis.astype(numpy.int64))
+        keys.sort()
+        return (keys % base) / 1000
+    return times[numpy.lexsort((times, url_ids))]
+
+
+# sum() of floats adds them one by one up to Python 3.11, later versions
+# compensate rounding errors. Sums of the numpy backend follow it, so the
+# result is the same as for lists.
+SEQUENTIAL_SUM = sum([1.0, 1e100, 1.0, -1e100]) == 0.0
+
+
+def _url_sums(url_ids, times, counts):
+    """ Returns sum() of times of every URL id, in order of the log. """
+    numpy = get_numpy()
+    grouped = times[numpy.argsort(url_ids, kind='stable')].tolist()
+    ends = numpy.cumsum(counts).tolist()
+    return numpy.array([
+        sum(grouped[start:end]) for start, end in zip([0] + ends, ends)
+    ], dtype=numpy.float64)
+
+
+def columnar_summaries(time_data, report_size=None, round_digits=3,
+                       percentiles=()):
+    """ Returns count, sum, max, median and percentiles of times for every
+    URL of columnar time_data, like summarize_times does for lists. If
+    report_size is set, only times of the top URLs are sorted.
+    """
+    numpy = get_numpy()
+    url_ids = numpy.frombuffer(time_data['url_ids'], dtype=numpy.int32)
+    times = numpy.frombuffer(time_data['times'], dtype=numpy.float64)
+    urls = list(time_data['urls'])
+    counts = numpy.bincount(url_ids, minlength=len(urls))
+    if SEQUENTIAL_SUM:
+        # bincount adds weights one by one in order of the log.
+        sums = numpy.bincount(url_ids, weights=times, minlength=len(urls))
+    else:
+        sums = _url_sums(url_ids, times, counts)
+
+    if report_size is None:
+        selected = numpy.arange(len(urls))
+        sorted_times = _sort_times_by_url(url_ids, times)
+        kept_counts = counts
+    else:
+        top = top_urls(enumerate(sums.tolist()), report_size, round_digits)
+        selected = numpy.array([url_id for url_id, _ in top],
+                               dtype=numpy.int64)
+        mask = numpy.zeros(len(urls), dtype=bool)
+        mask[selected] = True
+        kept = mask[url_ids]
+        sorted_times = _sort_times_by_url(url_ids[kept], times[kept])
+        kept_counts = numpy.where(mask, counts, 0)
+    starts = (numpy.cumsum(kept_counts) - kept_counts)[selected]
+    counts = counts[selected]
+    maxes = sorted_times[starts + counts - 1]
+    low = sorted_times[starts + (counts - 1) // 2]
+    high = sorted_times[starts + counts // 2]
+    medians = (low + high) / 2
+    quantiles = []
+    for percentile in percentiles:
+        rank = percentile / 100 * (counts - 1)
+        lows = numpy.floor(rank).astype(numpy.int64)
+        highs = numpy.minimum(lows + 1, counts - 1)
+        low = sorted_times[starts + lows]
+        quantiles.append(
+            low + (sorted_times[starts + highs] - low) * (rank - lows))
+    quantiles = (numpy.array(quantiles).T.tolist() if percentiles
+                 else [[]] * len(counts))
+    return zip([urls[url_id] for url_id in selected.tolist()],
+               counts.tolist(), sums[selected].tolist(), maxes.tolist(),
+               medians.tolist(), quantiles)
+
+
+def time_data_statistics(time_data, round_digits=3, report_size=None,
+                         percentiles=()):
+    """ Returns stats of URLs. If report_size is set, stats are calculated
+    only for report_size URLs with the largest time_sum. For every one of
+    percentiles (numbers from 0 to 100) a time_pNN column is added.
+    """
     logging.info('Start calculating statistics.')
-    stats = []
-    time_data = collect_time_data(log)
-    for url, times in time_data['items'].items():
-        count = len(times)
+    stats = list(iter_time_data_statistics(time_data, round_digits,
+                                           report_size, percentiles))
+    logging.info('End of calculation of statistics.')
+    return stats
+
+
+def iter_time_data_statistics(time_data, round_digits=3, report_size=None,
+                              percentiles=()):
+    """ Like time_data_statistics, but yields stats of URLs one by one. """
+    items = time_data.get('items')
+    percentiles = sorted(percentiles)
+    if 'times' in time_data:
+        summaries = columnar_summaries(time_data, report_size, round_digits,
+                                       percentiles)
+    elif report_size is not None:
+        url_sums = ((url, times_sum(times)) for url, times in items.items())
+        summaries = (
+            (url,) + summarize_times(items[url], percentiles)
+            for url, _ in top_urls(url_sums, report_size, round_digits)
+        )
+    else:
+        summaries = (
+            (url,) + summarize_times(times, percentiles)
+            for url, times in items.items()
+        )
+    columns = [percentile_column(percentile) for percentile in percentiles]
+    total_time_sum = round(time_data['total_time_sum'], 3)
+    for url, count, time_sum, time_max, time_med, quantiles in summaries:
         count_perc = count * 100 / time_data['requests_count']
-        time_sum = sum(times)
-        time_perc = time_sum / time_data['total_time_sum']
+        time_perc = time_sum / total_time_sum
         time_avg = time_sum / count
-        time_max = max(times)
-        time_med = median(times)
 
         data = {
             'url': url,
@@ -195,54 +2209,854 @@ def calculate_statistics(log, round_digits=3):
             'time_max': time_max,
             'time_med': round(time_med, round_digits),
         }
-        stats.append(data)
-    logging.info('End of calculation of statistics.')
-    return stats
+        for column, value in zip(columns, quantiles):
+            data[column] = round(value, round_digits)
+        yield data
 
 
-def stats_to_html(stats, report_size):
-    template_name = 'report.html'
+def percentile_column(percentile):
+    # 95 -> time_p95, 99.9 -> time_p99.9
+    return 'time_p%g' % percentile
+
+
+def read_report_template(template_name='report.html'):
+    """ Returns parts of the report template before and after
+    $table_json.
+    """
     template_path = os.path.join(
         os.path.dirname(os.path.abspath(__file__)),
         template_name
     )
     with open(template_path) as template_file:
-        template = Template(template_file.read())
-        logging.info('Render report with template %s', template_path)
+        template = template_file.read()
+    logging.info('Render report with template %s', template_path)
+    head, placeholder, tail = template.partition('$table_json')
+    if not placeholder:
+        raise RuntimeError(
+            'Template %s has no $table_json placeholder' % template_path)
+    return head, tail
+
 
-        data = sorted(
-            stats,
-            key=lambda x: x['time_sum'],
-            reverse=True)
+def iter_report_html(stats, report_size):
+    """ Yields parts of the report with report_size stats with the largest
+    time_sum. JSON of the table is produced row by row.
+    """
+    head, tail = read_report_template()
+    if report_size is None:
+        report_size = len(stats)
+    data = heapq.nlargest(report_size, stats, key=lambda x: x['time_sum'])
+    yield head
+    yield '['
+    for index, row in enumerate(data):
+        if index:
+            yield ', '
+        yield json.dumps(row)
+    yield ']'
+    yield tail
 
-        data_str = json.dumps(data[:report_size])
 
-        return template.safe_substitute(table_json=data_str)
+def stats_to_html(stats, report_size):
+    return ''.join(iter_report_html(stats, report_size))
 
 
-def save_report(report, path):
-    with open(path, 'w') as report_file:
-        report_file.write(report)
+def save_report(report, path, atomic=False):
+    """ Writes report (string or iterable of strings) to path. If atomic
+    is set, the report is written with atomic_write, so readers never see
+    a partial report.
+    """
+    if isinstance(report, str):
+        report = (report,)
+    with (atomic_write(path) if atomic else open(path, 'w')) as report_file:
+        for part in report:
+            report_file.write(part)
     logging.info('Report saved as %s', path)
 
 
-def process_log(config, force=False):
-    log = get_last_log(config.get('LOG_PREFIX'), config.get('LOG_DIR'))
-    if not log:
-        logging.info('No files to analyze')
-        return
+REPORT_MAGIC = b'LOGREP1\n'
+
+
+class ReportWriter(abc.ABC):
+    """ Writes rows of stats to file opened by save_rows.
+
+    Subclasses set extension and write rows. Writers with full set get
+    stats of all URLs, streamed right from the aggregate; others get
+    stats of REPORT_SIZE URLs with the largest time_sum.
+    """
+    extension = None
+    binary = False
+    full = True
+
+    def __init__(self, file):
+        self.file = file
+
+    @classmethod
+    def open(cls, path):
+        """ Returns atomic_write context of the report file. """
+        if cls.binary:
+            return atomic_write(path, 'wb')
+        return atomic_write(path, 'w', newline='')
+
+    @abc.abstractmethod
+    def write_row(self, row):
+        """ Writes one row of stats. """
+
+    def finish(self):
+        """ Writes the end of the report. """
+
+
+class HtmlReportWriter(ReportWriter):
+    """ The report page with the table sorted by time_sum. """
+    extension = 'html'
+    full = False
+
+    def __init__(self, file):
+        super().__init__(file)
+        self.rows = []
+
+    def write_row(self, row):
+        self.rows.append(row)
+
+    def finish(self):
+        for part in iter_report_html(self.rows, None):
+            self.file.write(part)
+
+
+class JsonLinesReportWriter(ReportWriter):
+    """ One JSON object per line. """
+    extension = 'jsonl'
+
+    def write_row(self, row):
+        self.file.write(json.dumps(row))
+        self.file.write('\n')
+
+
+class CsvReportWriter(ReportWriter):
+    """ CSV with the header of columns of the first row. """
+    extension = 'csv'
+
+    def __init__(self, file):
+        super().__init__(file)
+        self.writer = None
+
+    def write_row(self, row):
+        if self.writer is None:
+            self.writer = csv.DictWriter(self.file, list(row))
+            self.writer.writeheader()
+        self.writer.writerow(row)
+
+
+class ColumnarReportWriter(ReportWriter):
+    """ Binary file for big reports: magic, JSON header with names and
+    types of columns and zlib-compressed columns one after another.
+    Numbers are kept in arrays while rows come, strings in a buffer.
+    """
+    extension = 'columnar.bin'
+    binary = True
+
+    def __init__(self, file):
+        super().__init__(file)
+        self.columns = None
+        self.rows = 0
+
+    def write_row(self, row):
+        if self.columns is None:
+            self.columns = {
+                name: (io.BytesIO() if isinstance(value, str)
+                       else array.array('q' if isinstance(value, int)
+                                        else 'd'))
+                for name, value in row.items()
+            }
+        for name, column in self.columns.items():
+            if isinstance(column, io.BytesIO):
+                _write_str(column, row[name])
+            else:
+                column.append(row[name])
+        self.rows += 1
+
+    def finish(self):
+        columns = self.columns or {}
+        header = json.dumps({
+            'rows': self.rows,
+            'byteorder': sys.byteorder,
+            'columns': [
+                [name, 's' if isinstance(column, io.BytesIO)
+                 else column.typecode]
+                for name, column in columns.items()
+            ],
+        }).encode()
+        self.file.write(REPORT_MAGIC)
+        self.file.write(struct.pack('<I', len(header)))
+        self.file.write(header)
+        compressor = zlib.compressobj()
+        for column in columns.values():
+            data = (column.getvalue() if isinstance(column, io.BytesIO)
+                    else column.tobytes())
+            self.file.write(compressor.compress(data))
+        self.file.write(compressor.flush())
+
+
+def load_columnar_report(path):
+    """ Loads report written by ColumnarReportWriter. Returns dict of
+    columns: lists of strings or arrays of numbers.
+    """
+    with open(path, 'rb') as report:
+        if report.read(len(REPORT_MAGIC)) != REPORT_MAGIC:
+            raise ValueError('"%s" is not a columnar report' % path)
+        size, = struct.unpack('<I', report.read(4))
+        header = json.loads(report.read(size).decode())
+        buf = memoryview(zlib.decompress(report.read()))
+    rows = header['rows']
+    columns = {}
+    pos = 0
+    for name, typecode in header['columns']:
+        if typecode == 's':
+            values = []
+            for _ in range(rows):
+                value, pos = _read_str(buf, pos)
+                values.append(value)
+        else:
+            values, pos = _read_array(buf, pos, typecode, rows)
+            if header['byteorder'] != sys.byteorder:
+                values.byteswap()
+        columns[name] = values
+    return columns
+
+
+REPORT_WRITERS = {
+    'html': HtmlReportWriter,
+    'jsonl': JsonLinesReportWriter,
+    'csv': CsvReportWriter,
+    'columnar': ColumnarReportWriter,
+}
+
+
+def get_report_writers(config):
+    """ Returns writer classes of REPORT_FORMATS. """
+    formats = config.get('REPORT_FORMATS') or ['html']
+    for name in formats:
+        if name not in REPORT_WRITERS:
+            raise RuntimeError('Unknown report format %s' % name)
+    return [REPORT_WRITERS[name] for name in formats]
+
+
+def report_path(report_name, writer):
+    # report-2017.06.30.html -> report-2017.06.30.csv
+    return '%s.%s' % (os.path.splitext(report_name)[0], writer.extension)
+
+
+def report_exists(report_name, config):
+    """ Returns True if the report is saved in every format. """
+    return all(os.path.isfile(report_path(report_name, writer))
+               for writer in get_report_writers(config))
+
+
+def save_rows(rows, writers, report_name):
+    """ Writes every row with all writer classes at once. If writing
+    fails, old reports are left as they were.
+    """
+    paths = [report_path(report_name, writer) for writer in writers]
+    with contextlib.ExitStack() as stack:
+        opened = [writer(stack.enter_context(writer.open(path)))
+                  for writer, path in zip(writers, paths)]
+        for row in rows:
+            for writer in opened:
+                writer.write_row(row)
+        for writer in opened:
+            writer.finish()
+    for path in paths:
+        logging.info('Report saved as %s', path)
+
+
+def get_median_error(config):
+    """ Returns relative error of median or None for exact median. """
+    if config.get('EXACT_MEDIAN'):
+        return None
+    return config.get('MEDIAN_ERROR')
+
+
+def get_percentiles(config):
+    """ Returns sorted percentiles of the report columns. """
+    percentiles = sorted(config.get('PERCENTILES') or ())
+    for percentile in percentiles:
+        if not 0 < percentile < 100:
+            raise RuntimeError(
+                'Percentile %s is not between 0 and 100' % percentile)
+    return percentiles
+
+
+def get_stats_backend(config):
+    """ Returns 'python' or 'numpy'. numpy backend always calculates exact
+    median.
+    """
+    backend = config.get('STATS_BACKEND') or 'python'
+    if backend not in ('python', 'numpy'):
+        raise RuntimeError('Unknown statistics backend %s' % backend)
+    if backend == 'numpy' and get_numpy() is None:
+        raise RuntimeError('numpy is required for numpy statistics backend')
+    return backend
+
+
+def collect_checkpointed(log_path, config, checkpoint, metrics):
+    """ Like scan_log and collect_url_times, but saves a checkpoint to
+    the checkpoint file after every CHECKPOINT_BYTES of the log and
+    resumes from it. The result is the same as of uninterrupted parsing.
+    """
+    errors_threshold = config.get('MAX_PARS_ERRORS_PERC')
+    counters = ParseCounters(
+        errors_threshold, config.get('ERRORS_WARMUP_LINES') or 0,
+        log_size=os.path.getsize(log_path))
+    parser = get_log_parser(config.get('LOG_FORMAT'))
+    normalizer = get_url_normalizer(url_options(config))
+    median_error = get_median_error(config)
+    names = config.get('BREAKDOWNS') or []
+    signature = log_signature(log_path, config)
+    time_data, offset = load_checkpoint(checkpoint, signature, counters)
+    if time_data is None:
+        time_data = new_time_data(get_stats_backend(config))
+        if names:
+            time_data['breakdowns'] = {}
+        logging.info('Start parsing file %s', log_path)
+    else:
+        logging.info('Resume parsing file %s from byte %s of checkpoint %s',
+                     log_path, offset, checkpoint)
+        if normalizer is not None and normalizer.max_urls:
+            urls = time_data.get('urls') or time_data['items']
+            normalizer.urls.update(url for url in urls if url != OVERFLOW_URL)
+
+    progress = {'offset': offset, 'eof': False}
+    try:
+        for url_times in scan_log_segments(
+                log_path, parser, counters, progress,
+                config['CHECKPOINT_BYTES'],
+                get_decompressor(config.get('DECOMPRESSOR')), metrics,
+                breakdown_columns(names)):
+            url_times = count_breakdowns(
+                url_times, time_data.get('breakdowns'), names, normalizer)
+            aggregate_url_times(
+                time_data, normalize_url_times(url_times, normalizer),
+                median_error, metrics)
+            if not progress['eof']:
+                with metrics.timer('checkpoint'):
+                    save_checkpoint(checkpoint, time_data, signature,
+                                    progress['offset'], counters)
+    finally:
+        metrics.counters['bytes_read'] += os.path.getsize(log_path)
+        metrics.add_parse_counters(counters)
+    logging.info('End of parsing file.')
+
+    counters.check(errors_threshold)
+    return time_data
+
+
+def build_time_data(log_path, config, metrics=None, checkpoint=None):
+    """ Parses the log as configured. Returns not rounded time_data. If
+    checkpoint is a path, parsing in one process is resumable.
+    """
+    if metrics is None:
+        metrics = RunMetrics()
+    workers = config.get('WORKERS') or 1
+    errors_threshold = config.get('MAX_PARS_ERRORS_PERC')
+    errors_warmup = config.get('ERRORS_WARMUP_LINES') or 0
+    median_error = get_median_error(config)
+    backend = get_stats_backend(config)
+    names = config.get('BREAKDOWNS') or []
+    columns = breakdown_columns(names,
+                                get_log_parser(config.get('LOG_FORMAT')))
+    with metrics.timer('build'):
+        if workers > 1 and not log_path.endswith('.gz'):
+            return collect_time_data_parallel(
+                log_path, errors_threshold, workers, config.get('LOG_FORMAT'),
+                median_error, backend, url_options(config), metrics,
+                errors_warmup, names)
+        if checkpoint and config.get('CHECKPOINT_BYTES'):
+            return collect_checkpointed(log_path, config, checkpoint,
+                                        metrics)
+        records = scan_log(
+            log_path, errors_threshold, config.get('LOG_FORMAT'),
+            get_decompressor(config.get('DECOMPRESSOR')), metrics,
+            errors_warmup, columns)
+        normalizer = get_url_normalizer(url_options(config))
+        breakdowns = {}
+        url_times = normalize_url_times(
+            count_breakdowns(records, breakdowns, names, normalizer),
+            normalizer)
+        time_data = collect_url_times(url_times, median_error, backend,
+                                      metrics)
+        if names:
+            time_data['breakdowns'] = breakdowns
+        return time_data
+
+
+def aggregate_options(config):
+    """ Returns options of parsing and aggregation which change time_data. """
+    options = {
+        'log_format': config.get('LOG_FORMAT'),
+        'median_error': get_median_error(config),
+        'backend': get_stats_backend(config),
+        'urls': url_options(config),
+    }
+    # Only if set, so aggregates made before breakdowns stay valid.
+    if config.get('BREAKDOWNS'):
+        options['breakdowns'] = list(config['BREAKDOWNS'])
+    return options
+
+
+def log_signature(log_path, config):
+    """ Returns what the aggregate of the log depends on: the log file
+    itself and options of parsing and aggregation.
+    """
+    stat = os.stat(log_path)
+    signature = {
+        'log': os.path.basename(log_path),
+        'log_size': stat.st_size,
+        'log_mtime': stat.st_mtime,
+    }
+    signature.update(aggregate_options(config))
+    return signature
+
+
+def log_metrics(path, time_data, source):
+    """ Returns summary of one log for RunMetrics.logs. """
+    urls = time_data['urls'] if 'urls' in time_data else time_data['items']
+    return {
+        'log': path,
+        'source': source,
+        'requests': time_data['requests_count'],
+        'urls': len(urls),
+    }
+
+
+def load_time_data_timed(path, metrics):
+    logging.info('Load aggregate %s', path)
+    with metrics.timer('load_aggregate'):
+        time_data = load_time_data(path)[0]
+    metrics.logs.append(log_metrics(path, time_data, 'aggregate'))
+    return time_data
+
+
+def get_time_data(log, config, reparse=False, metrics=None):
+    """ Returns time_data of the log from its aggregate file if it is up
+    to date. Otherwise parses the log and saves the aggregate file.
+    """
+    if metrics is None:
+        metrics = RunMetrics()
+    aggregate_dir = config.get('AGGREGATE_DIR')
+    checkpoint = None
+    if aggregate_dir:
+        aggregate_name = construct_report_name(
+            log, aggregate_dir, 'aggregate', 'bin')
+        checkpoint = construct_report_name(
+            log, aggregate_dir, 'checkpoint', 'bin')
+        signature = log_signature(log.path, config)
+        if not reparse and os.path.isfile(aggregate_name):
+            header, _ = load_aggregate_header(aggregate_name)
+            if header and header.get('signature') == signature:
+                return load_time_data_timed(aggregate_name, metrics)
+    time_data = build_time_data(log.path, config, metrics, checkpoint)
+    metrics.logs.append(log_metrics(log.path, time_data, 'log'))
+    if aggregate_dir:
+        os.makedirs(aggregate_dir, exist_ok=True)
+        with metrics.timer('dump_aggregate'):
+            dump_time_data(time_data, aggregate_name, {'signature': signature})
+        logging.info('Aggregate saved as %s', aggregate_name)
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+    return time_data
+
+
+def write_report(time_data, config, report_name, metrics=None):
+    """ Writes the report in every format of REPORT_FORMATS: report_name
+    with the extension of the format. HTML gets stats only of REPORT_SIZE
+    URLs, other formats get stats of all URLs in one pass.
+    """
+    if metrics is None:
+        metrics = RunMetrics()
+    report_size = config.get('REPORT_SIZE')
+    percentiles = get_percentiles(config)
+    writers = get_report_writers(config)
+    top_writers = [writer for writer in writers if not writer.full]
+    full_writers = [writer for writer in writers if writer.full]
+    if top_writers:
+        with metrics.timer('statistics'):
+            stats = time_data_statistics(time_data, report_size=report_size,
+                                         percentiles=percentiles)
+        with metrics.timer('render'):
+            save_rows(stats, top_writers, report_name)
+    if full_writers:
+        with metrics.timer('export'):
+            save_rows(
+                iter_time_data_statistics(time_data,
+                                          percentiles=percentiles),
+                full_writers, report_name)
+    if time_data.get('breakdowns'):
+        with metrics.timer('render'):
+            tables = breakdown_tables(
+                time_data['breakdowns'], time_data['requests_count'],
+                time_data['total_time_sum'], report_size)
+            save_report(json.dumps(tables, indent=1),
+                        breakdowns_report_name(report_name), atomic=True)
+
+
+def breakdowns_report_name(report_name):
+    # report-2017.06.30.html -> report-2017.06.30.breakdowns.json
+    return os.path.splitext(report_name)[0] + '.breakdowns.json'
+
+
+def process_one_log(log, config, force=False, reparse=False, metrics=None):
     report_name = construct_report_name(log, config.get('REPORT_DIR'))
-    if force or not os.path.isfile(report_name):
-        log = parse_log(log.path, config.get('MAX_PARS_ERRORS_PERC'))
-        stats = calculate_statistics(log)
-        report_html = stats_to_html(stats, config.get('REPORT_SIZE'))
-        save_report(report_html, report_name)
+    if force or reparse or not report_exists(report_name, config):
+        time_data = get_time_data(log, config, reparse, metrics)
+        write_report(time_data, config, report_name, metrics=metrics)
     else:
         logging.info(
             'Report for %s already exists. Use --force to rewrite it.',
             log.path)
 
 
+def select_logs(config, process_all=False, index=None, pending=False):
+    """ Returns LogMeta of all logs or of the last one. With index, logs
+    are taken from it. With pending, only logs whose report is missing in
+    some of REPORT_FORMATS are returned of all logs; the index keeps
+    reports found, so only new logs are checked on disk.
+    """
+    log_prefix, log_dir = config.get('LOG_PREFIX'), config.get('LOG_DIR')
+    if not process_all:
+        if index is not None:
+            index.update()
+            return list(filter(None, [index.last()]))
+        return list(filter(None, [get_last_log(log_prefix, log_dir)]))
+    report_dir = config.get('REPORT_DIR')
+    if index is not None:
+        index.update()
+        if pending:
+            writers = get_report_writers(config)
+            return index.pending(report_dir, lambda log: [
+                report_path(construct_report_name(log, report_dir), writer)
+                for writer in writers])
+        return index.logs()
+    logs = get_logs(log_prefix, log_dir)
+    if pending:
+        logs = [log for log in logs if not report_exists(
+            construct_report_name(log, report_dir), config)]
+    return logs
+
+
+def process_log(config, force=False, process_all=False, reparse=False,
+                metrics=None):
+    """ Makes report for the last log, or for every log without report if
+    process_all is set. A failed log does not stop processing of others.
+    """
+    index = open_log_index(config)
+    try:
+        process_logs(config, force, process_all, reparse, metrics, index)
+    finally:
+        if index is not None:
+            index.save()
+
+
+def process_logs(config, force, process_all, reparse, metrics, index):
+    logs = select_logs(config, process_all, index, not (force or reparse))
+    if not logs:
+        logging.info('No files to analyze')
+    elif not process_all:
+        process_one_log(logs[0], config, force, reparse, metrics)
+    else:
+        for log in logs:
+            try:
+                process_one_log(log, config, force, reparse, metrics)
+            except (RuntimeError, OSError, ValueError) as err:
+                logging.error('Cannot process %s: %s', log.path, err)
+
+
+def source_configs(config):
+    """ Returns (name, config) for every source of SOURCES. A source is a
+    dict of config keys (LOG_PREFIX, LOG_DIR, REPORT_DIR, LOG_FORMAT...)
+    which override the common ones. Aggregates of a source are kept in
+    its own subdirectory of AGGREGATE_DIR unless it sets AGGREGATE_DIR.
+    """
+    common = {key: value for key, value in config.items()
+              if key != 'SOURCES'}
+    sources = []
+    for source in config.get('SOURCES') or []:
+        source = dict(source)
+        name = source.pop('NAME', None) or source.get('LOG_PREFIX')
+        if not name or name in dict(sources):
+            raise RuntimeError('Every source needs a unique NAME')
+        source_config = dict(common, **source)
+        if 'AGGREGATE_DIR' not in source and common.get('AGGREGATE_DIR'):
+            source_config['AGGREGATE_DIR'] = os.path.join(
+                common['AGGREGATE_DIR'], name)
+        sources.append((name, source_config))
+    return sources
+
+
+def source_time_data(log, config, reparse=False):
+    """ Returns time_data of the log and RunMetrics of getting it. Runs in
+    worker processes.
+    """
+    metrics = RunMetrics()
+    time_data = get_time_data(log, config, reparse, metrics)
+    return time_data, metrics
+
+
+async def process_source(name, config, pool, force=False, process_all=False,
+                         reparse=False):
+    """ Like process_log for one source. Logs are parsed in the pool,
+    directory scans and report writes run in threads. Returns RunMetrics
+    of the source.
+    """
+    loop = asyncio.get_running_loop()
+    metrics = RunMetrics()
+    index = await loop.run_in_executor(None, open_log_index, config)
+    try:
+        logs = await loop.run_in_executor(
+            None, select_logs, config, process_all, index,
+            not (force or reparse))
+        if not logs:
+            logging.info('[%s] No files to analyze', name)
+        for log in logs:
+            report_name = construct_report_name(log,
+                                                config.get('REPORT_DIR'))
+            if not (force or reparse) and report_exists(report_name,
+                                                        config):
+                logging.info('[%s] Report for %s already exists.', name,
+                             log.path)
+            else:
+                try:
+                    time_data, log_metrics = await loop.run_in_executor(
+                        pool, source_time_data, log, config, reparse)
+                    metrics.merge(log_metrics)
+                    await loop.run_in_executor(
+                        None, functools.partial(
+                            write_report, time_data, config, report_name,
+                            metrics=metrics))
+                except (RuntimeError, OSError, ValueError) as err:
+                    if not process_all:
+                        raise
+                    logging.error('[%s] Cannot process %s: %s', name,
+                                  log.path, err)
+    finally:
+        if index is not None:
+            await loop.run_in_executor(None, index.save)
+    return metrics
+
+
+async def _process_sources(sources, workers, force, process_all, reparse):
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return await asyncio.gather(
+            *(process_source(name, source_config, pool, force, process_all,
+                             reparse)
+              for name, source_config in sources),
+            return_exceptions=True)
+
+
+@log_time_execution
+def process_sources(config, force=False, process_all=False, reparse=False,
+                    metrics=None):
+    """ Processes all SOURCES concurrently in one process. A failed source
+    does not stop the others. Metrics of every source are added to
+    metrics and kept in metrics.sources.
+    """
+    sources = source_configs(config)
+    workers = config.get('SOURCE_WORKERS') or os.cpu_count()
+    logging.info('Process %s sources with %s workers', len(sources), workers)
+    results = asyncio.run(
+        _process_sources(sources, workers, force, process_all, reparse))
+    failed = []
+    for (name, _), result in zip(sources, results):
+        if isinstance(result, Exception):
+            logging.error('Source %s failed: %s', name, result)
+            failed.append(name)
+            if metrics is not None:
+                metrics.sources[name] = {'error': str(result)}
+            continue
+        if metrics is not None:
+            metrics.merge(result)
+            metrics.sources[name] = result.summary()
+    if failed:
+        raise RuntimeError('Failed sources: %s' % ', '.join(failed))
+
+
+def get_aggregates(aggregate_dir):
+    """ Returns LogMeta of all aggregate files in aggregate_dir. """
+    if not aggregate_dir or not os.path.isdir(aggregate_dir):
+        return []
+    pattern = re.compile(r'aggregate-(\d{4}\.\d{2}\.\d{2})\.bin$')
+    aggregates = []
+    for file in os.listdir(aggregate_dir):
+        match = pattern.match(file)
+        if match:
+            aggregates.append(LogMeta(
+                os.path.join(aggregate_dir, file),
+                datetime.strptime(match.group(1), '%Y.%m.%d')))
+    return sorted(aggregates, key=lambda aggregate: aggregate.date)
+
+
+def load_saved_time_data(aggregate, config, metrics=None):
+    """ Loads aggregate of a log which does not exist any more. Returns
+    None if the aggregate was made with other options of parsing.
+    """
+    header, _ = load_aggregate_header(aggregate.path)
+    signature = (header or {}).get('signature') or {}
+    options = aggregate_options(config)
+    if any(signature.get(key) != value for key, value in options.items()):
+        logging.warning('Aggregate %s was made with other options',
+                        aggregate.path)
+        return None
+    return load_time_data_timed(aggregate.path, metrics or RunMetrics())
+
+
+@log_time_execution
+def rollup_time_data(config, date_from, date_to, reparse=False,
+                     metrics=None):
+    """ Merges time_data of every day from date_from to date_to. Days are
+    taken from saved aggregates, logs without them are parsed. Returns
+    time_data and number of merged days.
+    """
+    def in_range(logmeta):
+        return date_from <= logmeta.date <= date_to
+
+    index = open_log_index(config)
+    logs = {
+        log.date: log
+        for log in select_logs(config, process_all=True, index=index)
+        if in_range(log)
+    }
+    if index is not None:
+        index.save()
+    aggregates = {
+        aggregate.date: aggregate
+        for aggregate in get_aggregates(config.get('AGGREGATE_DIR'))
+        if in_range(aggregate) and aggregate.date not in logs
+    }
+    time_data = new_time_data(get_stats_backend(config))
+    days = 0
+    for date in sorted(set(logs) | set(aggregates)):
+        try:
+            if date in logs:
+                day_data = get_time_data(logs[date], config, reparse,
+                                         metrics)
+            else:
+                day_data = load_saved_time_data(aggregates[date], config,
+                                                metrics)
+        except (RuntimeError, OSError, ValueError) as err:
+            logging.error('Cannot use data for %s: %s',
+                          date.strftime('%Y.%m.%d'), err)
+            continue
+        if day_data is not None:
+            merge_time_data(time_data, day_data)
+            days += 1
+    return time_data, days
+
+
+def construct_rollup_name(date_from, date_to, report_dir):
+    # report-2017.06.01-2017.06.30.html
+    report_name = 'report-%s-%s.html' % (
+        date_from.strftime('%Y.%m.%d'), date_to.strftime('%Y.%m.%d'))
+    return os.path.join(report_dir, report_name)
+
+
+def process_rollup(config, date_from, date_to, force=False, reparse=False,
+                   metrics=None):
+    """ Makes one report for all days from date_from to date_to. """
+    report_name = construct_rollup_name(
+        date_from, date_to, config.get('REPORT_DIR'))
+    if report_exists(report_name, config) and not (force or reparse):
+        logging.info('Report %s already exists. Use --force to rewrite it.',
+                     report_name)
+        return
+    time_data, days = rollup_time_data(
+        config, date_from, date_to, reparse, metrics)
+    if not days:
+        logging.info('No logs or aggregates to analyze')
+        return
+    logging.info('Merged data of %s days', days)
+    write_report(time_data, config, report_name, metrics=metrics)
+
+
+def follow_log(config, poll_interval=1):
+    """ Follows the active log (LOG_PREFIX.log without date) and rewrites
+    report-live.html every FOLLOW_INTERVAL seconds or FOLLOW_LINES lines.
+    Only new lines are parsed and added to the running aggregate. Medians
+    are always approximate, so the report costs the same however long
+    the log is followed.
+    """
+    log_path = os.path.join(
+        config.get('LOG_DIR'), '%s.log' % config.get('LOG_PREFIX'))
+    report_name = os.path.join(config.get('REPORT_DIR'), 'report-live.html')
+    interval = config.get('FOLLOW_INTERVAL')
+    max_lines = config.get('FOLLOW_LINES')
+    median_error = config.get('MEDIAN_ERROR') or 0.01
+    parser = get_log_parser(config.get('LOG_FORMAT'))
+    normalizer = get_url_normalizer(url_options(config))
+    names = config.get('BREAKDOWNS') or []
+    columns = breakdown_columns(names, parser)
+    counters = ParseCounters()
+    time_data = new_time_data()
+    if names:
+        time_data['breakdowns'] = {}
+    follower = LogFollower(log_path)
+
+    reported_total = 0
+    reported_at = time.monotonic()
+    try:
+        while True:
+            lines = follower.read()
+            if lines:
+                records = count_breakdowns(
+                    parse_url_times(lines, parser, counters, columns),
+                    time_data.get('breakdowns'), names, normalizer)
+                url_times = normalize_url_times(records, normalizer)
+                add_url_times(time_data, url_times, median_error)
+            new_lines = counters.total - reported_total
+            elapsed = time.monotonic() - reported_at
+            if new_lines and (new_lines >= max_lines or elapsed >= interval):
+                if time_data['requests_count']:
+                    write_report(time_data, config, report_name)
+                logging.info('Parsed %s lines, %s errors',
+                             counters.total, counters.errors)
+                reported_total = counters.total
+                reported_at = time.monotonic()
+            if not lines:
+                time.sleep(poll_interval)
+    finally:
+        follower.close()
+
+
+def run_profiled(func, prefix, *args):
+    """ Runs func under cProfile and tracemalloc. Saves binary profile to
+    prefix.prof and the top functions and allocation sites to prefix.txt.
+    """
+    profile = cProfile.Profile()
+    tracemalloc.start()
+    try:
+        return profile.runcall(func, *args)
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        profile.dump_stats(prefix + '.prof')
+        with open(prefix + '.txt', 'w') as report:
+            stats = pstats.Stats(profile, stream=report)
+            stats.sort_stats('cumulative').print_stats(40)
+            report.write('Traced memory: %d bytes, peak %d bytes\n\n'
+                         % (current, peak))
+            report.write('Top allocations alive at the end:\n')
+            for stat in snapshot.statistics('lineno')[:30]:
+                report.write('%s\n' % stat)
+        logging.info('Profile saved as %s.prof and %s.txt', prefix, prefix)
+
+
+def save_summary(summary, path):
+    """ Writes JSON summary of the run through a temporary file. """
+    with atomic_write(path) as summary_file:
+        json.dump(summary, summary_file, indent=2)
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y%m%d')
+
+
 def parse_args():
     analyzer_dir = os.path.dirname(os.path.abspath(__file__))
     default_config_path = os.path.join(analyzer_dir, 'log_analyzer.conf')
@@ -260,6 +3074,73 @@ def parse_args():
         action='store_true',
         help='Force analyze log file',
     )
+    parser.add_argument(
+        '--all',
+        dest='process_all',
+        action='store_true',
+        help='Analyze every log without report, not only the last one',
+    )
+    parser.add_argument(
+        '--reparse',
+        dest='reparse',
+        action='store_true',
+        help='Parse logs again even if their aggregates are saved',
+    )
+    parser.add_argument(
+        '--rollup',
+        dest='rollup',
+        nargs=2,
+        type=parse_date,
+        metavar=('FROM', 'TO'),
+        help='Make one report for days from FROM to TO (YYYYMMDD) by '
+             'merging their aggregates',
+    )
+    parser.add_argument(
+        '--follow',
+        dest='follow',
+        action='store_true',
+        help='Follow the active log and refresh report-live.html',
+    )
+    parser.add_argument(
+        '--profile',
+        dest='profile',
+        nargs='?',
+        const='log_analyzer',
+        metavar='PREFIX',
+        help='Profile the run with cProfile and tracemalloc and save '
+             'PREFIX.prof and PREFIX.txt',
+    )
+    parser.add_argument(
+        '--workers',
+        dest='workers',
+        type=int,
+        help='Number of processes for parsing of plain (not gz) logs',
+    )
+    parser.add_argument(
+        '--exact-median',
+        dest='exact_median',
+        action='store_true',
+        help='Keep all request times to calculate exact median',
+    )
+    parser.add_argument(
+        '--backend',
+        dest='backend',
+        choices=('python', 'numpy'),
+        help='Backend for calculation of statistics',
+    )
+    parser.add_argument(
+        '--format',
+        dest='report_formats',
+        nargs='+',
+        choices=sorted(REPORT_WRITERS),
+        help='Formats of the report (html by default)',
+    )
+    parser.add_argument(
+        '--decompressor',
+        dest='decompressor',
+        help='Command for decompression of gz logs (pigz, zcat, gzip), '
+             '"python" to use zlib or "auto"',
+    )
     args = parser.parse_args()
     return args
 
@@ -296,20 +3177,52 @@ def setup_logger(logfile):
         )
 
 
+def run(config, args, metrics):
+    if args.follow:
+        follow_log(config)
+    elif args.rollup:
+        process_rollup(config, args.rollup[0], args.rollup[1],
+                       args.force, args.reparse, metrics)
+    elif config.get('SOURCES'):
+        process_sources(config, args.force, args.process_all, args.reparse,
+                        metrics)
+    else:
+        process_log(config, args.force, args.process_all, args.reparse,
+                    metrics)
+
+
 def main(default_config):
     args = parse_args()
     config = load_config(args.config, default_config)
+    if args.workers:
+        config['WORKERS'] = args.workers
+    if args.exact_median:
+        config['EXACT_MEDIAN'] = True
+    if args.backend:
+        config['STATS_BACKEND'] = args.backend
+    if args.decompressor:
+        config['DECOMPRESSOR'] = args.decompressor
+    if args.report_formats:
+        config['REPORT_FORMATS'] = args.report_formats
     setup_logger(config.get('LOGFILE'))
 
     logging.info('[START]')
+    metrics = RunMetrics()
     try:
-        process_log(config, args.force)
+        if args.profile:
+            run_profiled(run, args.profile, config, args, metrics)
+        else:
+            run(config, args, metrics)
     except RuntimeError as err:
         logging.error(err)
     except KeyboardInterrupt:
         logging.error('Terminated by KeyboardInterrupt')
     except Exception as err:
         logging.exception(err)
+    summary = metrics.summary()
+    logging.info('Run summary: %s', json.dumps(summary))
+    if config.get('SUMMARY_FILE'):
+        save_summary(summary, config['SUMMARY_FILE'])
     logging.info('[END]')
 
 
@@ -0,0 +1,47 @@
+import logging
+import os
+import tempfile
+import unittest
+
+from ..benchmark import generate_lines, generate_log, measure_store, run_stage
+from ..log_analyzer import parse_line
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_generate_lines(self):
+        lines = list(generate_lines(200, urls=10, seed=1))
+        self.assertEqual(lines, list(generate_lines(200, urls=10, seed=1)))
+        self.assertNotEqual(lines, list(generate_lines(200, urls=10, seed=2)))
+        urls = {parse_line(line)['request'].split()[1] for line in lines}
+        self.assertLessEqual(len(urls), 10)
+
+    def test_generate_malformed_lines(self):
+        errors = 0
+        for line in generate_lines(1000, error_rate=0.1):
+            try:
+                parse_line(line)
+            except ValueError:
+                errors += 1
+        self.assertTrue(50 < errors < 150)
+
+    def test_run_stage(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in ('sample.log', 'sample.log.gz'):
+                log_path = os.path.join(tmp_dir, name)
+                generate_log(log_path, 100)
+                self.assertEqual(100, run_stage('read_lines', log_path))
+                self.assertEqual(100, run_stage('report', log_path))
+
+    def test_measure_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, 'sample.log')
+            generate_log(log_path, 100, urls=10)
+            # measure_store is meant for a fresh process and turns logs off.
+            self.addCleanup(logging.disable, logging.NOTSET)
+            result = measure_store(log_path)
+        self.assertLessEqual(result['lists']['urls'], 10)
+        self.assertGreater(result['lists']['bytes_per_line'], 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,33 @@
+import csv
+import gzip
+import json
 import os
+import tempfile
 import unittest
+from array import array
 from datetime import datetime
+from statistics import median
 from unittest import mock
 from unittest.mock import mock_open
 
-from ..log_analyzer import (LogMeta, calculate_statistics, collect_time_data,
-                            construct_report_name, date_from_name,
-                            get_last_log, parse_line, parse_log, read_lines,
-                            save_report, stats_to_html)
+from .. import log_analyzer
+from ..log_analyzer import (UI_SHORT_COLUMNS, UI_SHORT_PARSER, LogFollower,
+                            LogIndex, LogMeta, OVERFLOW_URL, ParseCounters,
+                            RunMetrics, TimeSketch, UrlNormalizer,
+                            add_url_times, atomic_write, breakdown_tables,
+                            build_time_data, calculate_statistics,
+                            collect_time_data, collect_time_data_parallel,
+                            compile_log_format, construct_report_name,
+                            date_from_name, dump_time_data, find_chunks,
+                            get_decompressor, get_last_log, get_log_parser,
+                            get_logs, load_columnar_report, load_time_data,
+                            new_time_data, parse_columns, parse_line,
+                            parse_lines, parse_log, read_byte_lines,
+                            read_gzip_blocks, read_lines, report_exists,
+                            rollup_time_data, save_report, scan_mapped_lines,
+                            select_logs, split_lines, stats_to_html,
+                            summarize_times, time_data_statistics,
+                            write_report)
 
 
 class TestLogAnalyzer(unittest.TestCase):
@@ -33,6 +53,79 @@ class TestLogAnalyzer(unittest.TestCase):
             ]
             self.assertEqual(get_last_log('sample', './log'), expect)
 
+    def test_get_logs(self):
+        expect = [
+            LogMeta('./log/sample.log-20170630.gz', datetime(2017, 6, 30)),
+            LogMeta('./log/sample.log-20170712.gz', datetime(2017, 7, 12)),
+            LogMeta('./log/sample.log-20170815', datetime(2017, 8, 15)),
+        ]
+        with mock.patch('os.listdir') as mock_listdir:
+            mock_listdir.return_value = [
+                'sample.log-20170815',
+                'sample.log-20170630.gz',
+                'sample.log-20170816agz',
+                'sample.log-20170712.gz',
+                'sample.log',
+            ]
+            self.assertEqual(expect, get_logs('sample', './log'))
+
+    def test_log_index(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in ('sample.log-20170630.gz', 'sample.log-20170712',
+                         'sample.log', 'other.log-20170801'):
+                open(os.path.join(tmp_dir, name), 'w').close()
+            index_path = os.path.join(tmp_dir, 'index', 'logs.json')
+            index = LogIndex(index_path, 'sample', tmp_dir)
+            index.update()
+            self.assertEqual(get_logs('sample', tmp_dir), index.logs())
+            self.assertEqual(get_last_log('sample', tmp_dir), index.last())
+            index.save()
+
+            os.remove(os.path.join(tmp_dir, 'sample.log-20170630.gz'))
+            open(os.path.join(tmp_dir, 'sample.log-20170815'), 'w').close()
+            index = LogIndex(index_path, 'sample', tmp_dir)
+            index.update()
+            self.assertEqual(get_logs('sample', tmp_dir), index.logs())
+
+            # pending logs are found by reports, not by the index
+            config = {'LOG_PREFIX': 'sample', 'LOG_DIR': tmp_dir,
+                      'REPORT_DIR': tmp_dir}
+            report_name = os.path.join(tmp_dir, 'report-2017.07.12.html')
+            open(report_name, 'w').close()
+            self.assertEqual(
+                [LogMeta(os.path.join(tmp_dir, 'sample.log-20170815'),
+                         datetime(2017, 8, 15))],
+                select_logs(config, True, index, pending=True))
+            config['REPORT_FORMATS'] = ['html', 'csv']
+            self.assertEqual(2, len(select_logs(config, True, index,
+                                                pending=True)))
+            os.remove(report_name)
+            self.assertEqual(index.logs(),
+                             select_logs(config, True, index, pending=True))
+
+            # reports found are recorded, only other logs are checked
+            config['REPORT_FORMATS'] = ['html']
+            open(report_name, 'w').close()
+            self.assertEqual(1, len(select_logs(config, True, index,
+                                                pending=True)))
+            index.save()
+            index = LogIndex(index_path, 'sample', tmp_dir)
+            with mock.patch('os.path.isfile',
+                            wraps=os.path.isfile) as isfile:
+                self.assertEqual(1, len(select_logs(config, True, index,
+                                                    pending=True)))
+            isfile.assert_called_once_with(
+                os.path.join(tmp_dir, 'report-2017.08.15.html'))
+            index.save()
+
+            # removed report changes mtime of the directory
+            os.remove(report_name)
+            stat = os.stat(tmp_dir)
+            os.utime(tmp_dir, ns=(stat.st_atime_ns,
+                                  stat.st_mtime_ns + 10 ** 9))
+            self.assertEqual(2, len(select_logs(config, True, index,
+                                                pending=True)))
+
     def test_construct_report_name(self):
         cases = (
             (
@@ -65,6 +158,44 @@ class TestLogAnalyzer(unittest.TestCase):
             for e in read_lines(filename_gz):
                 self.assertEqual(e, next(expect))
 
+    def test_split_lines(self):
+        blocks = (b'first\nsec', b'ond\n', b'', b'\nthi', b'rd')
+        expect = [b'first', b'second', b'', b'third']
+        self.assertEqual(expect, list(split_lines(blocks)))
+
+    def test_read_gzip_blocks_multi_member(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'sample.log.gz')
+            with open(path, 'wb') as log:
+                log.write(gzip.compress(b'test1\ntest2\n'))
+                log.write(gzip.compress(b'test3\n' * 1000))
+                log.write(b'\x00' * 10)
+            data = b''.join(read_gzip_blocks(path, block_size=16))
+            self.assertEqual(b'test1\ntest2\n' + b'test3\n' * 1000, data)
+            with open(path, 'r+b') as log:
+                log.truncate(40)
+            with self.assertRaises(EOFError):
+                b''.join(read_gzip_blocks(path))
+
+    def test_read_byte_lines_with_decompressor(self):
+        decompressor = get_decompressor('auto')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'sample.log.gz')
+            with open(path, 'wb') as log:
+                log.write(gzip.compress(b'test1\n'))
+                log.write(gzip.compress(b'test2\ntest3'))
+            for command in (None, decompressor):
+                with self.subTest(command=command):
+                    result = list(read_byte_lines(path, command))
+                    self.assertEqual([b'test1', b'test2', b'test3'], result)
+
+    def test_get_decompressor(self):
+        self.assertIsNone(get_decompressor('python'))
+        with mock.patch('shutil.which', return_value=None):
+            self.assertIsNone(get_decompressor('auto'))
+            with self.assertRaises(RuntimeError):
+                get_decompressor('pigz')
+
     def test_parse_line(self):
         line = ('1.99.174.176 3b81f63526fa8  - [29/Jun/2017:03:50:22 +0300]'
                 ' "GET /api/1/photogenic_banners/list/?server_name=WIN7RB4'
@@ -89,6 +220,42 @@ class TestLogAnalyzer(unittest.TestCase):
         result = parse_line(line)
         self.assertDictEqual(expected, result)
 
+    def test_parse_line_same_as_parse_columns(self):
+        cases = (
+            '1.99.174.176 3b81f63526fa8  - [29/Jun/2017:03:50:22 +0300] "GET /api/1/photo HTTP/1.1" 200 12 "-" "Python-urllib/2.7" "-" "1498697422-32900793-4708-9752770" "-" 0.100\n',
+            '1.99.174.176 3b81f63526fa8  - [29/Jun/2017:03:50:22 +0300] "GET /api/1/photo HTTP/1.1" 200 12 "" "Mozilla/5.0 " "-" "[1498697422]" "-" 0.100 trailer',
+            '1.99.174.176 [user] - [ 29/Jun/2017:03:50:22 +0300] "GET /api/1/photo HTTP/1.1" 200 12 "-" "-" "-" "-" "-" 0.100',
+            '1.99.174.176\t-\t-\t[29/Jun/2017:03:50:22 +0300]\t"POST /api/1/photo HTTP/1.1"\t404 0 "-" "-" "-" "-" "-" 1.5',
+        )
+        for case in cases:
+            with self.subTest(case=case):
+                expect = parse_columns(case, UI_SHORT_COLUMNS)
+                self.assertEqual(expect, parse_line(case))
+                self.assertEqual(
+                    (expect['request'].split()[1], expect['request_time']),
+                    get_log_parser().url_time(case.encode()))
+
+    def test_parse_line_with_extra_spaces(self):
+        # parse_columns loses its place after extra whitespace and rejects
+        # such lines, the regexp must not accept them either
+        line = ('1.2.3.4 - - [29/Jun/2017:03:50:22 +0300]'
+                ' "GET /api/1 HTTP/1.1" 200 927 "-" "Lynx" "-"'
+                ' "1498697422-2190034393-4708-9752759" "dc7161be3" 0.390')
+        cases = (
+            '  ' + line,
+            '\t' + line.replace(' - - ', ' -  - '),
+            line.replace(' - - ', ' -  -  '),
+            line.replace(' 927 ', ' 927   '),
+        )
+        for case in cases:
+            with self.subTest(case=case):
+                with self.assertRaises(ValueError):
+                    parse_columns(case, UI_SHORT_COLUMNS)
+                with self.assertRaises(ValueError):
+                    parse_line(case)
+                with self.assertRaises(ValueError):
+                    get_log_parser().url_time(case.encode())
+
     def test_parse_line_without_str(self):
         cases = ({}, 123, 1.1, [], set())
         for case in cases:
@@ -108,6 +275,41 @@ class TestLogAnalyzer(unittest.TestCase):
                 with self.assertRaises(ValueError):
                     parse_line(case)
 
+    def test_compile_log_format(self):
+        log_format = (
+            "log_format ui_short '$remote_addr $remote_user $http_x_real_ip "
+            "[$time_local] \"$request\" ' '$status $body_bytes_sent "
+            "\"$http_referer\" ' '\"$http_user_agent\" "
+            "\"$http_x_forwarded_for\" \"$http_X_REQUEST_ID\" "
+            "\"$http_X_RB_USER\" ' '$request_time';"
+        )
+        line = ('1.99.174.176 3b81f63526fa8  - [29/Jun/2017:03:50:22 +0300]'
+                ' "GET /api/1/photo HTTP/1.1" 200 12 "-" "Python-urllib/2.7"'
+                ' "-" "1498697422-32900793-4708-9752770" "-" 0.133')
+        parser = compile_log_format(log_format)
+        self.assertIs(parser, compile_log_format(log_format))
+        self.assertEqual(parse_line(line), parse_line(line, parser))
+
+    def test_compile_log_format_custom(self):
+        parser = compile_log_format('$remote_addr [$time_local] "$request" '
+                                    '$status $request_time')
+        expect = {
+            'remote_addr': '1.1.1.1',
+            'time_local': '29/Jun/2017:03:50:22 +0300',
+            'request': 'GET /api/1/photo HTTP/1.1',
+            'status': 404,
+            'request_time': 1.0,
+        }
+        line = ('1.1.1.1 [29/Jun/2017:03:50:22 +0300] '
+                '"GET /api/1/photo HTTP/1.1" 404 1')
+        self.assertEqual(expect, parser.parse(line))
+        with self.assertRaisesRegex(ValueError, 'Cannot parse status'):
+            parser.parse(line.replace('404', 'x'))
+
+    def test_get_log_parser_without_required_columns(self):
+        with self.assertRaises(ValueError):
+            get_log_parser('$remote_addr $status')
+
     def test_parse_log(self):
         data = (
             '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" 0.300',
@@ -141,8 +343,8 @@ class TestLogAnalyzer(unittest.TestCase):
             'total_time_sum': 1.6,
             'requests_count': 7,
             'items': {
-                '/api/v2/banner': [0.3, 0.4, 0.5],
-                '/api/1/photo': [0.1, 0.1, 0.1, 0.1],
+                '/api/v2/banner': array('d', [0.3, 0.4, 0.5]),
+                '/api/1/photo': array('d', [0.1, 0.1, 0.1, 0.1]),
             }
         }
         result = collect_time_data(data)
@@ -163,6 +365,532 @@ class TestLogAnalyzer(unittest.TestCase):
             with self.assertRaises(RuntimeError):
                 list(parse_log('sample.log', 10))
 
+    def test_find_chunks(self):
+        data = b'first line\nsecond\n\nthird line is longer\nlast'
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'sample.log')
+            with open(path, 'wb') as log:
+                log.write(data)
+            for chunks_count in range(1, 8):
+                with self.subTest(chunks_count=chunks_count):
+                    chunks = find_chunks(path, chunks_count)
+                    self.assertEqual(0, chunks[0][0])
+                    self.assertEqual(len(data), chunks[-1][1])
+                    for (_, end), (start, _) in zip(chunks, chunks[1:]):
+                        self.assertEqual(end, start)
+                        self.assertEqual(b'\n', data[end - 1:end])
+
+    def test_scan_mapped_lines(self):
+        line = ('1.99.174.176 3b81f63526fa8  - [29/Jun/2017:03:50:22 +0300] '
+                '"GET /api/%d HTTP/1.1" 200 12 "-" "Python-urllib/2.7" "-" '
+                '"1498697422-32900793-4708-9752770" "-" 0.%03d')
+        lines = [line % (i % 7, i) for i in range(50)]
+        lines[10] = 'bad line'
+        expect = [('/api/%d' % (i % 7), i / 1000) for i in range(50)]
+        del expect[10]
+        parser = get_log_parser()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'sample.log')
+            with open(path, 'w') as log:
+                log.write('\n'.join(lines))
+            for chunks_count in (1, 4):
+                with self.subTest(chunks_count=chunks_count):
+                    counters = ParseCounters()
+                    result = []
+                    for start, end in find_chunks(path, chunks_count):
+                        result.extend(scan_mapped_lines(
+                            path, parser, counters, start, end))
+                    self.assertEqual(expect, result)
+                    self.assertEqual((50, 1), (counters.total,
+                                               counters.errors))
+                    self.assertEqual({'remote_addr': 1}, counters.columns)
+
+    def test_collect_time_data_parallel(self):
+        line = ('1.99.174.176 3b81f63526fa8  - [29/Jun/2017:03:50:22 +0300] '
+                '"GET /api/%d HTTP/1.1" 200 12 "-" "Python-urllib/2.7" "-" '
+                '"1498697422-32900793-4708-9752770" "-" 0.%03d\n')
+        lines = [line % (i % 7, i) for i in range(200)] + ['bad line\n']
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'sample.log')
+            with open(path, 'w') as log:
+                log.writelines(lines)
+            expect = collect_time_data(parse_log(path, 10))
+            result = collect_time_data_parallel(path, 10, workers=3)
+            self.assertEqual(expect, result)
+            with self.assertRaises(RuntimeError):
+                collect_time_data_parallel(path, 0, workers=3)
+
+            # sums of sketches do not depend on the split of the log
+            config = dict(log_analyzer.config, MAX_PARS_ERRORS_PERC=10)
+            expect = time_data_statistics(build_time_data(path, config),
+                                          round_digits=20)
+            for workers in (2, 3, 5):
+                with self.subTest(workers=workers):
+                    result = build_time_data(path,
+                                             dict(config, WORKERS=workers))
+                    self.assertEqual(
+                        expect, time_data_statistics(result, round_digits=20))
+
+            # URLs beyond MAX_URLS are the same as in one process
+            config = {'MAX_PARS_ERRORS_PERC': 10, 'MAX_URLS': 3,
+                      'BREAKDOWNS': ['url_status']}
+            expect = build_time_data(path, config)
+            result = build_time_data(path, dict(config, WORKERS=3))
+            self.assertEqual(['/api/0', '/api/1', '/api/2', OVERFLOW_URL],
+                             list(result['items']))
+            self.assertEqual(time_data_statistics(expect),
+                             time_data_statistics(result))
+            self.assertEqual(expect['breakdowns'], result['breakdowns'])
+
+            # aborted early, but the errors reach the summary
+            with open(path, 'w') as log:
+                log.writelines(['bad line\n'] * 100 + lines[:100])
+            metrics = RunMetrics()
+            with self.assertRaises(RuntimeError):
+                collect_time_data_parallel(path, 10, workers=2,
+                                           metrics=metrics, errors_warmup=10)
+            summary = metrics.summary()
+            self.assertGreater(summary['parse_errors'], 10)
+            self.assertGreater(summary['lines_read'], 10)
+            self.assertIn('remote_addr', summary['parse_error_examples'])
+
+    def test_run_metrics(self):
+        line = ('1.99.174.176 3b81f63526fa8  - [29/Jun/2017:03:50:22 +0300] '
+                '"GET /api/%d HTTP/1.1" 200 12 "-" "Python-urllib/2.7" "-" '
+                '"1498697422-32900793-4708-9752770" "-" 0.%03d\n')
+        lines = [line % (i % 7, i) for i in range(200)]
+        lines += ['bad line\n', line.replace('0.%03d', '-') % 1]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'sample.log')
+            with open(path, 'w') as log:
+                log.writelines(lines)
+            for workers in (1, 2):
+                with self.subTest(workers=workers):
+                    metrics = RunMetrics()
+                    config = dict(log_analyzer.config, WORKERS=workers)
+                    log_analyzer.build_time_data(path, config, metrics)
+                    summary = metrics.summary()
+                    self.assertEqual(os.path.getsize(path),
+                                     summary['bytes_read'])
+                    self.assertEqual(202, summary['lines_read'])
+                    self.assertEqual(200, summary['lines_parsed'])
+                    self.assertEqual({'remote_addr': 1, 'request_time': 1},
+                                     summary['parse_errors_by_column'])
+                    self.assertTrue({'build', 'parse', 'aggregate'}
+                                    <= set(summary['timings']))
+                    json.dumps(summary)
+
+        metrics = RunMetrics()
+        metrics.logs.extend([{'log': 'a', 'urls': 7}, {'log': 'b', 'urls': 3}])
+        self.assertEqual(7, metrics.summary()['max_urls_per_log'])
+
+    def test_parse_counters(self):
+        bad_line = ('1.99.174.176 3b81f63526fa8  - [29/Jun/2017:03:50:22 '
+                    '+0300] "GET /api HTTP/1.1" 200 12 "-" "-" "-" "-" "-" -')
+        good_line = bad_line[:-1] + '0.1'
+
+        def scan(lines, warmup=100):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                log_path = os.path.join(tmp_dir, 'sample.log')
+                with open(log_path, 'w') as log:
+                    log.write('\n'.join(lines))
+                counters = ParseCounters(
+                    errors_threshold=10, warmup=warmup, samples=2,
+                    log_size=os.path.getsize(log_path))
+                for _ in scan_mapped_lines(log_path, UI_SHORT_PARSER,
+                                           counters):
+                    pass
+                return counters
+
+        with self.assertLogs(level='ERROR') as logs:
+            with self.assertRaises(RuntimeError):
+                scan(['bad'] * 5 + [bad_line] * 5 + [''] * 1000)
+        self.assertEqual(4, len(logs.records))
+
+        counters = ParseCounters(errors_threshold=10, warmup=100, samples=2)
+        lines = iter(['bad'] * 5 + [bad_line] * 5 + [''] * 1000)
+        with self.assertLogs(level='ERROR'):
+            list(parse_lines(lines, UI_SHORT_PARSER, counters))
+        self.assertEqual(1010, counters.total)
+        self.assertEqual({'remote_addr': 1005, 'request_time': 5},
+                         counters.columns)
+        self.assertEqual(2, len(counters.examples['request_time']))
+        with self.assertRaises(RuntimeError):
+            counters.check(10)
+
+        # errors only at the start, but 4% of the whole log
+        with self.assertLogs(level='ERROR'):
+            counters = scan([bad_line] * 200 + [good_line] * 4800)
+        self.assertEqual((5000, 200), (counters.total, counters.errors))
+        counters.check(10)
+
+        # stopped when errors are more than 10% of the whole log
+        with self.assertLogs(level='ERROR'):
+            with self.assertRaises(RuntimeError):
+                scan([bad_line] * 1000 + [good_line] * 1000)
+
+    def test_scan_log_gzip_early_abort(self):
+        line = ('1.99.174.176 3b81f63526fa8  - [29/Jun/2017:03:50:22 +0300] '
+                '"GET /api/1 HTTP/1.1" 200 12 "-" "-" "-" "-" "-" %s\n')
+        lines = [line % '-'] * 2000 + [line % '0.1'] * 20000
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, 'sample.log.gz')
+            with gzip.open(log_path, 'wt') as log:
+                log.writelines(lines)
+            for decompressor in (None, get_decompressor('auto')):
+                with self.subTest(decompressor=decompressor):
+                    # with all read ahead bytes counted, the log is short
+                    metrics = RunMetrics()
+                    with mock.patch.object(log_analyzer, 'READ_AHEAD', 0), \
+                            self.assertLogs(level='ERROR'), \
+                            self.assertRaises(RuntimeError):
+                        list(log_analyzer.scan_log(
+                            log_path, 5, decompressor=decompressor,
+                            metrics=metrics, errors_warmup=100))
+                    self.assertLess(metrics.summary()['lines_read'],
+                                    len(lines))
+                    # read ahead is not counted, 9% is under 10%
+                    with self.assertLogs(level='ERROR'):
+                        result = list(log_analyzer.scan_log(
+                            log_path, 10, decompressor=decompressor,
+                            errors_warmup=100))
+                    self.assertEqual(20000, len(result))
+
+    def test_log_follower(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, 'sample.log')
+            follower = LogFollower(log_path, block_size=4)
+            self.assertEqual([], follower.read())
+            with open(log_path, 'wb') as log:
+                log.write(b'one\ntw')
+            self.assertEqual([b'one'], follower.read())
+            self.assertEqual([], follower.read())
+            with open(log_path, 'ab') as log:
+                log.write(b'o\n')
+            self.assertEqual([b'two'], follower.read())
+            # logrotate: the old file gets the last line, a new one appears
+            os.rename(log_path, log_path + '.1')
+            with open(log_path + '.1', 'ab') as log:
+                log.write(b'3\n')
+            with open(log_path, 'wb') as log:
+                log.write(b'4\n')
+            self.assertEqual([b'3'], follower.read())
+            self.assertEqual([], follower.read())
+            self.assertEqual([b'4'], follower.read())
+            # copytruncate
+            with open(log_path, 'wb') as log:
+                log.write(b'')
+            self.assertEqual([], follower.read())
+            with open(log_path, 'wb') as log:
+                log.write(b'5\n')
+            self.assertEqual([b'5'], follower.read())
+            follower.close()
+
+    def test_url_normalizer(self):
+        normalizer = UrlNormalizer(
+            rules=['uuid', 'numeric', (r'(?<=/)v\d+(?=/)', '{version}')],
+            query_params=['server_name'])
+        cases = [
+            ('/api/1/photogenic_banners/list/?server_name=WIN7RB4&x=1',
+             '/api/{id}/photogenic_banners/list/?server_name=WIN7RB4'),
+            ('/api/v2/banner/25019354', '/api/{version}/banner/{id}'),
+            ('/api/v2/slot/4705/groups', '/api/{version}/slot/{id}/groups'),
+            ('/export/appinstall_raw/2017-06-29/',
+             '/export/appinstall_raw/2017-06-29/'),
+            ('/agency/1e3fbb8a-1b13-4dd6-9e4a-6b8ad1a8bb73/?limit=10',
+             '/agency/{uuid}/'),
+            ('/api/1234abc/', '/api/1234abc/'),
+        ]
+        for url, expect in cases:
+            self.assertEqual(expect, normalizer.normalize(url))
+
+        normalizer = UrlNormalizer(max_urls=2)
+        self.assertEqual(
+            ['/a', '/b', OVERFLOW_URL, '/a', '/b'],
+            [normalizer.normalize(url) for url in ('/a', '/b', '/c', '/a',
+                                                   '/b')])
+        with self.assertRaises(RuntimeError):
+            UrlNormalizer(rules=['unknown'])
+
+    def test_time_sketch(self):
+        times = [i / 1000 for i in range(1, 1000)] + [0.0, 0.0, 30.5]
+        sketch = TimeSketch(0.01)
+        for time in times:
+            sketch.add(time)
+        self.assertEqual(len(times), sketch.count)
+        self.assertEqual(sum(round(time * 1000) for time in times) / 1000,
+                         sketch.time_sum)
+        self.assertEqual(30.5, sketch.time_max)
+        expect = median(times)
+        self.assertLessEqual(abs(sketch.median() - expect), expect * 0.01)
+
+    def test_time_sketch_median_even_count(self):
+        for times in ([0.1, 0.3], [0.05, 2.0], [0.0, 0.001, 5.0, 60.0]):
+            with self.subTest(times=times):
+                sketch = TimeSketch(0.01)
+                for time in times:
+                    sketch.add(time)
+                expect = median(times)
+                self.assertLessEqual(abs(sketch.median() - expect),
+                                     expect * 0.01)
+
+    def test_time_sketch_merge(self):
+        first, second, whole = (TimeSketch(0.02) for _ in range(3))
+        for i in range(1, 500):
+            (first if i % 3 else second).add(i / 100)
+            whole.add(i / 100)
+        first.merge(second)
+        self.assertEqual(whole.bins, first.bins)
+        self.assertEqual(whole.count, first.count)
+        self.assertEqual(whole.median(), first.median())
+        with self.assertRaises(ValueError):
+            first.merge(TimeSketch(0.01))
+
+    def test_calculate_statistics_with_median_error(self):
+        log = [
+            {'request': 'GET /api/%d HTTP/1.1' % (i % 3),
+             'request_time': i / 100}
+            for i in range(1, 298)
+        ]
+        exact = calculate_statistics(log)
+        result = calculate_statistics(log, median_error=0.01)
+        for exact_row, row in zip(exact, result):
+            self.assertEqual(exact_row['count'], row['count'])
+            self.assertEqual(exact_row['time_sum'], row['time_sum'])
+            self.assertEqual(exact_row['time_max'], row['time_max'])
+            self.assertAlmostEqual(
+                exact_row['time_med'], row['time_med'],
+                delta=exact_row['time_med'] * 0.01 + 0.001)
+
+    def test_collect_time_data_columnar(self):
+        log = (
+            {'request': 'GET /api/v2/banner HTTP/1.1', 'request_time': 0.3},
+            {'request': 'GET /api/1/photo HTTP/1.1', 'request_time': 0.1},
+            {'request': 'GET /api/v2/banner HTTP/1.1', 'request_time': 0.4},
+        )
+        result = collect_time_data(log, backend='numpy')
+        self.assertEqual(0.8, result['total_time_sum'])
+        self.assertEqual(3, result['requests_count'])
+        self.assertEqual({'/api/v2/banner': 0, '/api/1/photo': 1},
+                         result['urls'])
+        self.assertEqual([0, 1, 0], result['url_ids'].tolist())
+        self.assertEqual([0.3, 0.1, 0.4], result['times'].tolist())
+
+    @unittest.skipUnless(log_analyzer.get_numpy(), 'numpy is not installed')
+    def test_calculate_statistics_numpy(self):
+        cases = (
+            [i / 1000 for i in range(500)],
+            [i / 7 for i in range(500)],
+        )
+        for times in cases:
+            with self.subTest(times=times[:3]):
+                log = [
+                    {'request': 'GET /api/%d HTTP/1.1' % (i * i % 11),
+                     'request_time': time}
+                    for i, time in enumerate(reversed(times))
+                ]
+                expect = calculate_statistics(log)
+                result = calculate_statistics(log, backend='numpy')
+                self.assertEqual(expect, result)
+
+    @unittest.skipUnless(log_analyzer.get_numpy(), 'numpy is not installed')
+    def test_time_data_statistics_numpy_percentiles(self):
+        # Sums are taken in order of the log, not of the sorted times.
+        url_times = [('/api/%d' % (i * i % 11), (500 - i) / 7)
+                     for i in range(500)]
+        expect, result = (
+            time_data_statistics(
+                add_url_times(new_time_data(backend), url_times),
+                round_digits=20, percentiles=[75, 95, 99])
+            for backend in ('python', 'numpy'))
+        self.assertEqual(expect, result)
+        with mock.patch.object(log_analyzer, 'SEQUENTIAL_SUM',
+                               not log_analyzer.SEQUENTIAL_SUM):
+            self.assertEqual(expect, time_data_statistics(
+                add_url_times(new_time_data('numpy'), url_times),
+                round_digits=20, percentiles=[75, 95, 99]))
+        times = [time for url, time in url_times if url == '/api/0']
+        self.assertEqual(sum(times),
+                         summarize_times(times, [75, 95, 99])[1])
+
+    def test_time_data_statistics_percentiles(self):
+        url_times = [('/api/%d' % (i % 2), i / 100) for i in range(1, 202)]
+        backends = ['python']
+        if log_analyzer.get_numpy():
+            backends.append('numpy')
+        for backend in backends:
+            with self.subTest(backend=backend):
+                time_data = add_url_times(new_time_data(backend), url_times)
+                row, _ = time_data_statistics(time_data,
+                                              percentiles=[99, 75])
+                self.assertEqual('/api/1', row['url'])
+                # times of /api/1 are 0.01, 0.03, ... 2.01
+                self.assertEqual(1.51, row['time_p75'])
+                self.assertEqual(1.99, row['time_p99'])
+                self.assertNotIn('time_p95', row)
+        time_data = add_url_times(new_time_data(), url_times, 0.01)
+        row, _ = time_data_statistics(time_data, percentiles=[75, 99])
+        self.assertAlmostEqual(1.51, row['time_p75'], delta=0.0151)
+        self.assertAlmostEqual(1.99, row['time_p99'], delta=0.0199)
+
+    def test_dump_load_time_data(self):
+        url_times = [
+            ('/api/%d' % (i % 5), i / 1000) for i in range(300)
+        ] + [('/api/\u0444', 0.0)]
+        time_data_cases = {
+            'lists': collect_time_data(()),
+            'sketch': collect_time_data((), median_error=0.01),
+            'columnar': collect_time_data((), backend='numpy'),
+        }
+        for kind, time_data in time_data_cases.items():
+            with self.subTest(kind=kind):
+                add_url_times(time_data, url_times,
+                              0.01 if kind == 'sketch' else None)
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    path = os.path.join(tmp_dir, 'aggregate.bin')
+                    dump_time_data(time_data, path, {'signature': 1})
+                    self.assertEqual(['aggregate.bin'], os.listdir(tmp_dir))
+                    result, header = load_time_data(path)
+                self.assertEqual(1, header['signature'])
+                self.assertEqual(kind, header['kind'])
+                self.assertEqual(
+                    time_data_statistics(time_data),
+                    time_data_statistics(result))
+
+    def test_breakdowns(self):
+        line = ('%s -  - [29/Jun/2017:%s +0300] "GET %s HTTP/1.1" %d 927 '
+                '"-" "-" "-" "-" "-" %s\n')
+        lines = [
+            line % ('1.1.1.1', '03:50:22', '/api/1', 200, '0.5'),
+            line % ('1.1.1.1', '03:51:00', '/api/1', 404, '0.2'),
+            line % ('2.2.2.2', '04:10:00', '/api/2', 500, '1.0'),
+            line % ('1.1.1.1', '04:11:00', '/api/1', 200, '0.3'),
+        ]
+        config = {'MAX_PARS_ERRORS_PERC': 10,
+                  'BREAKDOWNS': ['status', 'url_status', 'hour', 'client']}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, 'nginx-access-ui.log-20170629')
+            with open(log_path, 'w') as f:
+                f.writelines(lines)
+            time_data = build_time_data(log_path, config)
+            path = os.path.join(tmp_dir, 'aggregate.bin')
+            dump_time_data(time_data, path)
+            loaded, header = load_time_data(path)
+        self.assertTrue(header['breakdowns'])
+        self.assertEqual(time_data['breakdowns'], loaded['breakdowns'])
+        self.assertEqual({('/api/1', '2xx'): [2, 800000, 0.5],
+                          ('/api/1', '4xx'): [1, 200000, 0.2],
+                          ('/api/2', '5xx'): [1, 1000000, 1.0]},
+                         loaded['breakdowns']['url_status'])
+        tables = breakdown_tables(loaded['breakdowns'], 4, 2.0, report_size=1)
+        self.assertEqual(['2xx', '4xx', '5xx'],
+                         [row['status'] for row in tables['status']])
+        self.assertEqual({'status': '2xx', 'count': 2, 'count_perc': 50.0,
+                          'time_sum': 0.8, 'time_perc': 0.4,
+                          'time_avg': 0.4, 'time_max': 0.5},
+                         tables['status'][0])
+        self.assertEqual(['2017-06-29 03:00', '2017-06-29 04:00'],
+                         [row['time'] for row in tables['hour']])
+        self.assertEqual([('/api/2', '5xx')],
+                         [(row['url'], row['status'])
+                          for row in tables['url_status']])
+        self.assertEqual(['1.1.1.1'],
+                         [row['client'] for row in tables['client']])
+
+    def test_rollup_time_data(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = dict(log_analyzer.config, LOG_DIR=tmp_dir,
+                          AGGREGATE_DIR=tmp_dir)
+            options = log_analyzer.aggregate_options(config)
+            for day, times in ((1, [0.1, 0.3]), (2, [0.2]), (3, [5.0])):
+                time_data = collect_time_data((), median_error=0.01)
+                add_url_times(time_data, [('/api', t) for t in times], 0.01)
+                dump_time_data(
+                    time_data,
+                    os.path.join(tmp_dir, 'aggregate-2017.06.0%d.bin' % day),
+                    {'signature': dict(options)})
+            dump_time_data(
+                collect_time_data([{'request': 'GET /api HTTP/1.1',
+                                    'request_time': 1.0}]),
+                os.path.join(tmp_dir, 'aggregate-2017.06.04.bin'),
+                {'signature': dict(options, median_error=None)})
+
+            time_data, days = rollup_time_data(
+                config, datetime(2017, 6, 1), datetime(2017, 6, 4))
+        self.assertEqual(3, days)
+        stats, = time_data_statistics(time_data)
+        self.assertEqual(4, stats['count'])
+        self.assertEqual(5.6, stats['time_sum'])
+        self.assertEqual(5.0, stats['time_max'])
+
+    def test_collect_checkpointed(self):
+        lines = ''.join(
+            '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/%d '
+            'HTTP/1.1" 200 927 "-" "-" "-" "-" "-" 0.%03d\n' % (i % 7, i)
+            for i in range(100)) + 'broken\n'
+        save_checkpoint = log_analyzer.save_checkpoint
+        calls = []
+
+        def interrupt(*args):
+            save_checkpoint(*args)
+            calls.append(args)
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = dict(log_analyzer.config, CHECKPOINT_BYTES=1000,
+                          MEDIAN_ERROR=None, MAX_PARS_ERRORS_PERC=5)
+            checkpoint = os.path.join(tmp_dir, 'checkpoint.bin')
+            for name, open_func in (('sample.log', open),
+                                    ('sample.log.gz', gzip.open)):
+                with self.subTest(name=name):
+                    path = os.path.join(tmp_dir, name)
+                    with open_func(path, 'wt') as log:
+                        log.write(lines)
+                    expect = log_analyzer.build_time_data(path, config)
+                    calls.clear()
+                    with mock.patch.object(log_analyzer, 'save_checkpoint',
+                                           side_effect=interrupt):
+                        with self.assertRaises(KeyboardInterrupt):
+                            log_analyzer.build_time_data(
+                                path, config, checkpoint=checkpoint)
+                    self.assertTrue(os.path.isfile(checkpoint))
+                    metrics = RunMetrics()
+                    result = log_analyzer.build_time_data(
+                        path, config, metrics, checkpoint)
+                    self.assertEqual(expect, result)
+                    self.assertEqual(101, metrics.counters['total'])
+                    self.assertEqual(1, metrics.counters['errors'])
+                    os.remove(checkpoint)
+
+    def test_process_sources(self):
+        line = (
+            '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/'
+            'banner HTTP/1.1" 200 927 "-" "-" "-" "-" "-" 0.300\n')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sources = []
+            for name, text in (('ui', line), ('api', 'broken\n')):
+                log_dir = os.path.join(tmp_dir, name)
+                os.mkdir(log_dir)
+                with open(os.path.join(log_dir, name + '.log-20170630'),
+                          'w') as log:
+                    log.write(text * 3)
+                sources.append({'LOG_PREFIX': name, 'LOG_DIR': log_dir,
+                                'REPORT_DIR': log_dir})
+            config = dict(log_analyzer.config, SOURCES=sources,
+                          SOURCE_WORKERS=2,
+                          AGGREGATE_DIR=os.path.join(tmp_dir, 'aggregates'))
+            metrics = RunMetrics()
+            with self.assertRaisesRegex(RuntimeError, 'api'):
+                log_analyzer.process_sources(config, metrics=metrics)
+            self.assertTrue(os.path.isfile(
+                os.path.join(tmp_dir, 'ui', 'report-2017.06.30.html')))
+            self.assertTrue(os.path.isfile(os.path.join(
+                tmp_dir, 'aggregates', 'ui', 'aggregate-2017.06.30.bin')))
+        summary = metrics.summary()
+        self.assertEqual(3, summary['sources']['ui']['lines_parsed'])
+        self.assertIn('error', summary['sources']['api'])
+
     def test_calculate_statistics(self):
         round_digits = 3
         log = (
@@ -206,6 +934,26 @@ class TestLogAnalyzer(unittest.TestCase):
         result = calculate_statistics(log)
         self.assertEqual(result, expect_stats)
 
+    def test_time_data_statistics_top(self):
+        url_times = [
+            ('/api/%d' % (i % 50), (i % 7) / 1000) for i in range(1000)
+        ]
+        kinds = [(None, 'python'), (0.01, 'python')]
+        if log_analyzer.get_numpy() is not None:
+            kinds.append((None, 'numpy'))
+        for median_error, backend in kinds:
+            with self.subTest(median_error=median_error, backend=backend):
+                time_data = add_url_times(
+                    collect_time_data((), backend=backend), url_times,
+                    median_error)
+                stats = sorted(time_data_statistics(time_data),
+                               key=lambda x: x['time_sum'], reverse=True)
+                for report_size in (0, 7, 100):
+                    self.assertEqual(
+                        stats[:report_size],
+                        time_data_statistics(time_data,
+                                             report_size=report_size))
+
     def test_stats_to_html(self):
         template = '''<html>
         <script>
@@ -241,6 +989,73 @@ class TestLogAnalyzer(unittest.TestCase):
             handle = m()
             handle.write.assert_called_with(report)
 
+    def test_atomic_write(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'summary.json')
+            with atomic_write(path) as summary:
+                summary.write('old')
+            with self.assertRaises(ValueError):
+                with atomic_write(path) as summary:
+                    summary.write('new')
+                    raise ValueError
+            self.assertEqual(['summary.json'], os.listdir(tmp_dir))
+            with open(path) as summary:
+                self.assertEqual('old', summary.read())
+
+            def rows():
+                yield {'url': '/api/1', 'count': 1}
+                raise ValueError
+            writers = log_analyzer.get_report_writers(
+                {'REPORT_FORMATS': ['html', 'csv', 'columnar']})
+            with self.assertRaises(ValueError):
+                log_analyzer.save_rows(
+                    rows(), writers,
+                    os.path.join(tmp_dir, 'report-2017.06.30.html'))
+            self.assertEqual(['summary.json'], os.listdir(tmp_dir))
+
+    def test_report_writer_is_abstract(self):
+        class IncompleteWriter(log_analyzer.ReportWriter):
+            extension = 'txt'
+
+        with self.assertRaises(TypeError):
+            IncompleteWriter(None)
+
+    def test_write_report_formats(self):
+        url_times = [('/api/%d' % (i % 5), i / 100) for i in range(1, 100)]
+        time_data = add_url_times(new_time_data(), url_times)
+        config = {'REPORT_SIZE': 2, 'PERCENTILES': [95],
+                  'REPORT_FORMATS': ['html', 'jsonl', 'csv', 'columnar']}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_name = os.path.join(tmp_dir, 'report-2017.06.30.html')
+            self.assertFalse(report_exists(report_name, config))
+            write_report(time_data, config, report_name)
+            self.assertTrue(report_exists(report_name, config))
+            self.assertEqual(
+                ['report-2017.06.30.columnar.bin', 'report-2017.06.30.csv',
+                 'report-2017.06.30.html', 'report-2017.06.30.jsonl'],
+                sorted(os.listdir(tmp_dir)))
+            with open(report_name) as report:
+                self.assertEqual(2, report.read().count('{"url": '))
+            with open(os.path.join(tmp_dir,
+                                   'report-2017.06.30.jsonl')) as report:
+                rows = [json.loads(line) for line in report]
+            with open(os.path.join(tmp_dir, 'report-2017.06.30.csv'),
+                      newline='') as report:
+                csv_rows = list(csv.DictReader(report))
+            columns = load_columnar_report(
+                os.path.join(tmp_dir, 'report-2017.06.30.columnar.bin'))
+        self.assertEqual(time_data_statistics(time_data, percentiles=[95]),
+                         rows)
+        self.assertEqual([row['url'] for row in rows],
+                         [row['url'] for row in csv_rows])
+        self.assertEqual(str(rows[0]['time_p95']), csv_rows[0]['time_p95'])
+        self.assertEqual(
+            rows, [dict(zip(columns, values))
+                   for values in zip(*columns.values())])
+        with self.assertRaises(RuntimeError):
+            write_report(time_data, {'REPORT_FORMATS': ['xml']},
+                         report_name)
+
 
 if __name__ == '__main__':
     unittest.main()